@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+
+import binascii
+import bisect
+import collections
+import itertools
+import logging
+import struct
+
+from .utils import BYTE_BITS, bits_to_int, bits_to_str
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+_WORD = struct.Struct('<Q')
+_WORD_BITS = 64
+_FIND_WINDOW = 1 << 16
+
+
+def _read_int(data, position, size):
+    byte = position >> 3
+    shift = position & 7
+    if shift + size <= _WORD_BITS and byte + 8 <= len(data):
+        word = _WORD.unpack_from(data, byte)[0]
+    else:
+        chunk = bytearray(data[byte:byte + ((shift + size + 7) >> 3)])
+        if not chunk:
+            return 0
+        chunk.reverse()
+        word = int(binascii.hexlify(chunk), 16)
+    return (word >> shift) & ((1 << size) - 1)
+
+
+class BitReader(object):
+    ''' Read-only view over the bits of a buffer, LSB-first in each byte. '''
+
+    def __init__(self, data, offset=0, size=None, indexed=True):
+        self._data = data
+        self._offset = offset
+        self._size = len(data) * 8 - offset if size is None else size
+        self._indexed = indexed
+        self._shared = _SharedBuffer(data)
+
+    @classmethod
+    def from_bits(cls, bits):
+        return cls(bits_to_str(bits), size=len(bits))
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def offset(self):
+        return self._offset
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step is not None:
+            raise TypeError("BitReader only supports [start:end] slicing")
+        start, end, _step = index.indices(self._size)
+        view = BitReader(self._data, self._offset + start,
+                         max(end - start, 0), self._indexed)
+        view._shared = self._shared  # pylint: disable=protected-access
+        return view
+
+    def __str__(self):
+        return self.to_bits()
+
+    def __getstate__(self):
+        # Search tables are not pickled, they are rebuilt on demand
+        state = self.__dict__.copy()
+        del state['_shared']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shared = _SharedBuffer(self._data)
+
+    def read_int(self, position, size):
+        available = self._size - position
+        if available < size:
+            if available <= 0:
+                return 0
+            size = available
+        return _read_int(self._data, self._offset + position, size)
+
+    def span(self, start, end):
+        return Span(self, start, end)
+
+    def to_bits(self, start=0, end=None):
+        end = self._size if end is None else min(end, self._size)
+        if end <= start:
+            return ''
+        start += self._offset
+        end += self._offset
+        first_byte = start >> 3
+        chunk = bytearray(self._data[first_byte:(end + 7) >> 3])
+        bits = ''.join([BYTE_BITS[b] for b in chunk])
+        return bits[start - first_byte * 8:end - first_byte * 8]
+
+    def find(self, pattern, start=0, end=None):
+        '''
+        Returns the first index of the bit string `pattern` at or after
+        `start` (and before `end`), or -1. Searches a window at a time.
+        '''
+        size = len(pattern)
+        if not size:
+            return start
+        first = self._offset + start
+        last = self._last(size, end)
+        while first <= last:
+            window_end, positions = self._window(pattern, first)
+            index = bisect.bisect_left(positions, first)
+            if index < len(positions):
+                found = positions[index]
+                return found - self._offset if found <= last else -1
+            first = window_end + 1
+        return -1
+
+    def _window(self, pattern, first):
+        start, end, positions = self._shared.windows.get(pattern,
+                                                         (0, -1, None))
+        if start <= first <= end:
+            return end, positions
+        size = len(pattern)
+        value = bits_to_int(pattern[::-1])
+        end = min(first + _FIND_WINDOW, len(self._data) * 8 - size)
+        positions = sorted(itertools.chain.from_iterable(
+            self._iter_shifted(value, size, shift, first, end)
+            for shift in xrange(8)))
+        self._shared.windows[pattern] = (first, end, positions)
+        return end, positions
+
+    def _last(self, size, end):
+        last = self._size - size
+        if end is not None:
+            last = min(last, end - 1)
+        return self._offset + last
+
+    def find_indexed(self, pattern, start=0, end=None):
+        '''
+        Same as `find`, but answered from a table of all the occurrences,
+        unless the reader is not `indexed`.
+        '''
+        if not self._indexed:
+            return self.find(pattern, start, end)
+        positions = self.occurrences(pattern)
+        index = bisect.bisect_left(positions, self._offset + start)
+        if (index < len(positions) and
+                positions[index] <= self._last(len(pattern), end)):
+            return positions[index] - self._offset
+        return -1
+
+    def occurrences(self, pattern):
+        ''' Returns the absolute positions of `pattern` in the buffer. '''
+        try:
+            return self._shared.occurrences[pattern]
+        except KeyError:
+            pass
+        size = len(pattern)
+        value = bits_to_int(pattern[::-1])
+        last = len(self._data) * 8 - size
+        positions = sorted(itertools.chain.from_iterable(
+            self._iter_shifted(value, size, shift, 0, last)
+            for shift in xrange(8)))
+        self._shared.occurrences[pattern] = positions
+        return positions
+
+    def _iter_shifted(self, value, size, shift, first, last):
+        anchor_start = (shift + 7) >> 3
+        anchor_end = (shift + size) >> 3
+        if anchor_end <= anchor_start:
+            for position in self._scan(value, size, shift, first, last):
+                yield position
+            return
+        shifted = value << shift
+        anchor = ''.join(chr((shifted >> (8 * i)) & 0xff)
+                         for i in xrange(anchor_start, anchor_end))
+        search = self._shared.searchable()
+        begin = max(first >> 3, 0) + anchor_start
+        end = (last >> 3) + anchor_end + 1
+        while True:
+            index = search.find(anchor, begin, end)
+            if index < 0:
+                return
+            position = (index - anchor_start) * 8 + shift
+            if position > last:
+                return
+            if (position >= first and
+                    _read_int(self._data, position, size) == value):
+                yield position
+            begin = index + 1
+
+    def _scan(self, value, size, shift, first, last):
+        position = (first >> 3) * 8 + shift
+        if position < first:
+            position += 8
+        while position <= last:
+            if _read_int(self._data, position, size) == value:
+                yield position
+            position += 8
+
+
+class _SharedBuffer(object):  # pylint: disable=too-few-public-methods
+    def __init__(self, data):
+        self._data = data
+        self._searchable = None
+        self.occurrences = {}
+        self.windows = {}
+
+    def searchable(self):
+        if self._searchable is None:
+            self._searchable = (self._data if hasattr(self._data, 'find')
+                                else self._data.tobytes())
+        return self._searchable
+
+
+class Span(collections.namedtuple('Span', ['reader', 'start', 'end'])):
+    ''' Bits of a `BitReader`, copied out on demand. '''
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+    def to_bits(self, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        return self.reader.to_bits(self.start + start, self.start + end)
+
+    def write(self, writer, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        writer.copy(self.reader, self.start + start, self.start + end)
+
+    def __eq__(self, other):
+        if isinstance(other, (Span, basestring)):
+            return self.to_bits() == str(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self.to_bits())
+
+    def __str__(self):
+        return self.to_bits()
+
+    def __repr__(self):
+        return 'Span({!r})'.format(self.to_bits())
+
+
+def as_reader(bits):
+    if isinstance(bits, BitReader):
+        return bits
+    return BitReader.from_bits(bits)
+
+
+class BitWriter(object):
+    ''' Bit stream written to `outputs` (if any) every `buffer_size` bytes. '''
+
+    def __init__(self, outputs=None, buffer_size=1 << 16):
+        self._buffer = bytearray()
+        self._pending = 0
+        self._pending_size = 0
+        self._outputs = outputs
+        self._buffer_size = buffer_size
+        self._written = 0
+
+    def __len__(self):
+        return ((self._written + len(self._buffer)) * 8 +
+                self._pending_size)
+
+    def write(self, value, size):
+        ''' Appends the `size` lowest bits of `value`. '''
+        self._pending |= (value & ((1 << size) - 1)) << self._pending_size
+        self._pending_size += size
+        if self._pending_size >= 8:
+            self._flush()
+
+    def write_bits(self, bits):
+        if bits:
+            self.write(int(bits[::-1], 2), len(bits))
+
+    def write_bytes(self, data, size=None):
+        ''' Appends the first `size` bits of the bytes `data`. '''
+        size = len(data) * 8 if size is None else size
+        if self._pending_size:
+            self.copy(BitReader(data), 0, size)
+            return
+        whole = size >> 3
+        self._buffer += data[:whole]
+        self._drain(self._buffer_size)
+        if size & 7:
+            self.write(bytearray(data[whole:whole + 1])[0], size & 7)
+
+    def copy(self, reader, start, end):
+        ''' Appends the bits between `start` and `end` of a `BitReader`. '''
+        step = self._buffer_size * 8
+        if not self._pending_size and not (reader.offset + start) & 7:
+            whole = start + max(min(end, len(reader)) - start, 0) // 8 * 8
+            for chunk_start in xrange(start, whole, step):
+                first = (reader.offset + chunk_start) >> 3
+                last = (reader.offset + min(chunk_start + step, whole)) >> 3
+                self._buffer += reader.data[first:last]
+                self._drain(self._buffer_size)
+            start = whole
+        for chunk_start in xrange(start, end, step):
+            size = min(step, end - chunk_start)
+            self.write(reader.read_int(chunk_start, size), size)
+
+    def _flush(self):
+        count = self._pending_size >> 3
+        size = count * 8
+        chunk = self._pending & ((1 << size) - 1)
+        if count <= 8:
+            self._buffer += _WORD.pack(chunk)[:count]
+        else:
+            self._buffer += binascii.unhexlify(
+                '{:0{}x}'.format(chunk, count * 2))[::-1]
+        self._pending >>= size
+        self._pending_size -= size
+        self._drain(self._buffer_size)
+
+    def _drain(self, size):
+        if (self._outputs is None or not self._buffer or
+                len(self._buffer) < size):
+            return
+        contents = bytes(self._buffer)
+        for output in self._outputs:
+            output.write(contents)
+        self._written += len(contents)
+        del self._buffer[:]
+
+    def finish(self):
+        ''' Writes the rest of the stream to the outputs. '''
+        if self._pending_size:
+            self._buffer.append(self._pending)
+            self._pending = 0
+            self._pending_size = 0
+        self._drain(0)
+
+    def getvalue(self):
+        ''' Returns the bytes not written to the outputs yet. '''
+        if self._pending_size:
+            return bytes(self._buffer) + chr(self._pending)
+        return bytes(self._buffer)
+
+    def to_bits(self):
+        bits = ''.join([BYTE_BITS[b] for b in self._buffer])
+        if self._pending_size:
+            bits += BYTE_BITS[self._pending][:self._pending_size]
+        return bits
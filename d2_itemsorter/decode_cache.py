@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+
+import collections
+
+
+class DecodeCache(object):
+    '''
+    Bounded LRU cache of decoded records. `key(reader, offset)` returns
+    `(key, end)`, or None to decode without the cache.
+    '''
+
+    def __init__(self, key, refresh=None, max_size=1024):
+        self._key = key
+        self._refresh = [(field, offset, type_) for field, (offset, type_)
+                         in (refresh or {}).items()]
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def read(self, read, reader, offset, parent=None):
+        cached = self._key(reader, offset)
+        if cached is None:
+            return read(reader, offset, parent)
+        key, end = cached
+        try:
+            cls, values = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            record, position = read(reader, offset, parent)
+            if position == end:
+                # The origin is left out, so the cache does not keep the
+                # decoded data alive
+                values = record.to_dict()
+                del values['__origin']
+                self._entries[key] = (record.__class__, values)
+                if len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            return record, position
+        self.hits += 1
+        self._entries[key] = (cls, values)
+        values = dict(values)
+        for field, field_offset, type_ in self._refresh:
+            values[field] = type_.read(reader, offset + field_offset)[0]
+        values['__origin'] = reader.span(offset, end)
+        record = cls.from_dict(values)
+        record.track_changes()
+        return record, end
@@ -29,13 +29,41 @@ def default_sort(items):
     return sorted(items, key=default_sort_key)
 
 
+# `types` is the set of item types that `filter` matches exactly, if it only
+# depends on the item type
 ItemFilter = namedtuple_with_defaults('ItemFilter',
-                                      ['name', 'filter', 'sort'],
-                                      defaults={'sort': default_sort})
+                                      ['name', 'filter', 'sort', 'types'],
+                                      defaults={'sort': default_sort,
+                                                'types': None})
 
 
 def item_type_filter(item_type):
-    return ItemFilter(name=item_type, filter=lambda i: i.type() == item_type)
+    return ItemFilter(name=item_type, filter=lambda i: i.type() == item_type,
+                      types=frozenset([item_type]))
+
+
+class FilterIndex(object):
+    ''' Finds the first of a list of `ItemFilter`s that matches an item. '''
+
+    def __init__(self, filters):
+        self._predicates = []
+        self._by_type = {}
+        for index, item_filter in enumerate(filters):
+            if item_filter.types is None:
+                self._predicates.append((index, item_filter))
+            else:
+                for item_type in item_filter.types:
+                    self._by_type.setdefault(item_type, (index, item_filter))
+        self._no_match = (len(filters), None)
+
+    def match(self, item):
+        index, match = self._by_type.get(item.type(), self._no_match)
+        for predicate_index, item_filter in self._predicates:
+            if predicate_index > index:
+                break
+            if item_filter.filter(item):
+                return item_filter
+        return match
 
 
 def items_to_rows(items):
@@ -7,7 +7,7 @@ import collections
 from pignacio_scripts.namedtuple import namedtuple_with_defaults
 
 from .logger import Logger
-from .schema import Integer, BinarySchema, SchemaPiece
+from .schema import Integer, BinaryType, ParseError
 
 PropertyDef = namedtuple_with_defaults('PropertyDef',
                                        ['id', 'field_sizes', 'fmt_string',
@@ -23,6 +23,16 @@ class Property(_Property):
     def as_game_str(self):
         return self.definition.fmt_string.format(*self.values)
 
+    def __reduce__(self):
+        # Known definitions are pickled by id, so they stay shared
+        if _PROPERTIES.get(self.definition.id) is self.definition:
+            return (_restore_property, (self.definition.id, self.values))
+        return (Property, tuple(self))
+
+
+def _restore_property(prop_id, values):
+    return _interned(_PROPERTIES[prop_id], values)[0]
+
 _PROPERTIES = {p.id: p for p in [
     PropertyDef(0, [10], '{:+d} to Strength', offsets=[32]),
     PropertyDef(1, [10], '{:+d} to Energy', offsets=[32]),
@@ -197,61 +207,149 @@ _PROPERTIES = {p.id: p for p in [
 ]}  # yapf: disable
 
 # _PROPERTIES = {}
+_ID_SIZE = 9
 _LIST_TERMINATOR = 0x1ff
 
 MISSING_PROPERTY_IDS = collections.Counter()
+INTERNED_PROPERTIES = collections.Counter()
+
+_INTERNED = {}
+
+
+def intern_property(definition, values):
+    ''' Returns the shared `Property` for `definition` and `values`. '''
+    prop, hit = _interned(definition, values)
+    INTERNED_PROPERTIES['hits' if hit else 'misses'] += 1
+    return prop
+
+
+def _interned(definition, values):
+    values = tuple(values)
+    key = (id(definition), values)
+    try:
+        return _INTERNED[key], True
+    except KeyError:
+        # The Property keeps the definition alive, so its id is not reused
+        prop = _INTERNED[key] = Property(definition, values)
+        return prop, False
+
+
+def clear_interned_properties():
+    _INTERNED.clear()
+    INTERNED_PROPERTIES.clear()
+
+
+class PropertyLayout(object):  # pylint: disable=too-few-public-methods
+    ''' Reads the values of a property as a single integer. '''
+    __slots__ = ('definition', 'size', 'shifts', 'masks', 'offsets', 'fields',
+                 'last_shift')
 
+    def __init__(self, definition):
+        self.definition = definition
+        self.shifts = []
+        self.masks = []
+        size = 0
+        for field_size in definition.field_sizes:
+            self.shifts.append(size)
+            self.masks.append((1 << field_size) - 1)
+            size += field_size
+        self.size = size
+        self.last_shift = self.shifts[-1] if self.shifts else 0
+        self.offsets = list(definition.offsets or
+                            [0] * len(definition.field_sizes))
+        self.fields = zip(self.shifts, self.masks, self.offsets)
 
-class PropertyList(object):
+    def unpack(self, word):
+        return [((word >> shift) & mask) - offset
+                for shift, mask, offset in self.fields]
+
+    def pack(self, values):
+        ''' Returns `values` packed in an int, or None if they do not fit. '''
+        if len(values) != len(self.fields):
+            return None
+        word = 0
+        for (shift, mask, offset), value in zip(self.fields, values):
+            if not isinstance(value, (int, long)):
+                return None
+            value += offset
+            if not 0 <= value <= mask:
+                return None
+            word |= value << shift
+        return word
+
+
+def property_table(properties):
+    ''' Returns the `PropertyLayout` of every property ID. '''
+    table = [None] * (1 << _ID_SIZE)
+    for prop_id, prop_def in properties.items():
+        table[prop_id] = PropertyLayout(prop_def)
+    return table
+
+
+class PropertyList(BinaryType):
     def __init__(self, properties=None, terminator=None):
         self._properties = _PROPERTIES if properties is None else properties
         self._terminator = _LIST_TERMINATOR if terminator is None else terminator
+        self._table = property_table(self._properties)
 
-    def from_bits(self, bits, **kwargs):
-        position = 0
+    def read(self, reader, offset, **kwargs):
+        position = offset
         properties = []
         terminated = False
+        table = self._table
+        read_int = reader.read_int
+        end = len(reader)
         while True:
-            prop_id, advanced = Integer(9).from_bits(bits[position:])
-            position += advanced
+            prop_id = read_int(position, _ID_SIZE)
             if prop_id == self._terminator:
+                position += _ID_SIZE
                 terminated = True
                 break
-            try:
-                prop_def = self._properties[prop_id]
-            except KeyError:
+            layout = table[prop_id]
+            if layout is None:
                 MISSING_PROPERTY_IDS[prop_id] += 1
                 Logger.warn('Unknown property ID: "{}"', prop_id)
-                position -= advanced
                 break
-            else:
-                values, advanced = self._get_fields_schema(prop_def).from_bits(
-                    bits[position:])
-                position += advanced
-                values = [values[i] for i in xrange(len(prop_def.field_sizes))]
-                if prop_def.offsets is not None:
-                    values = [v - prop_def.offsets[i]
-                              for i, v in enumerate(values)]
-                properties.append(Property(prop_def, values))
+            position += _ID_SIZE
+            if position + layout.last_shift > end:
+                raise ParseError("EOD!")
+            properties.append(intern_property(
+                layout.definition,
+                layout.unpack(read_int(position, layout.size))))
+            position += layout.size
 
         return PropList(properties, terminated), position
 
-    def to_bits(self, proplist, **kwargs):
-        res = ''
+    def skip(self, reader, offset, **kwargs):
+        position = offset
+        table = self._table
+        end = len(reader)
+        while True:
+            prop_id = reader.read_int(position, _ID_SIZE)
+            if prop_id == self._terminator:
+                return position + _ID_SIZE
+            layout = table[prop_id]
+            if layout is None:
+                return position
+            position += _ID_SIZE
+            if position + layout.last_shift > end:
+                raise ParseError("EOD!")
+            position += layout.size
+
+    def write(self, writer, proplist, **kwargs):
         for prop in proplist.properties:
-            res += Integer(9).to_bits(prop.definition.id)
-            values = prop.values
-            if prop.definition.offsets:
-                values = [v + prop.definition.offsets[i]
-                          for i, v in enumerate(values)]
-            res += self._get_fields_schema(prop.definition).to_bits(
-                {i: v
-                 for i, v in enumerate(values)})
+            Integer(_ID_SIZE).write(writer, prop.definition.id)
+            layout = self._table[prop.definition.id]
+            if layout is None or layout.definition is not prop.definition:
+                layout = PropertyLayout(prop.definition)
+            word = layout.pack(prop.values)
+            if word is None:
+                # Let Integer (or a missing value) raise the appropriate error
+                values = dict(enumerate(prop.values))
+                for index, size in enumerate(prop.definition.field_sizes):
+                    Integer(size).write(writer,
+                                        values[index] + layout.offsets[index])
+            else:
+                writer.write(word, layout.size)
         if proplist.terminated:
-            res += Integer(9).to_bits(self._terminator)
-        return res
-
-    @staticmethod
-    def _get_fields_schema(prop_def):
-        return BinarySchema((SchemaPiece(i, Integer(s))
-                             for i, s in enumerate(prop_def.field_sizes)))
+            Integer(_ID_SIZE).write(writer, self._terminator)
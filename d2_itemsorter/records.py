@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+
+import collections
+
+from .bitstream import Span
+
+_MISSING = object()
+_NO_CHANGES = frozenset()
+_INTERNAL_FIELDS = frozenset(['__origin', '__unparsed', '__parent'])
+
+
+class Record(object):
+    ''' Mapping decoded by a `BinarySchema`, tracking its changed fields. '''
+    __slots__ = ('_changed', '_extra', '_lists')
+    _fields = ()
+    _slots = {}
+    _slot_items = ()
+
+    def __init__(self, *args, **kwargs):
+        self._changed = None
+        self._extra = None
+        self._lists = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    @classmethod
+    def from_dict(cls, values):
+        record = cls()
+        slots = cls._slots
+        for key, value in values.iteritems():
+            try:
+                setattr(record, slots[key], value)
+            except KeyError:
+                record[key] = value
+        return record
+
+    def track_changes(self):
+        self._changed = _NO_CHANGES
+        self._lists = tuple((key, value, tuple(value))
+                            for key, value in self.iteritems()
+                            if isinstance(value, list)) or None
+
+    @property
+    def changed(self):
+        ''' Fields changed since decoding, or None if not tracked. '''
+        if self._lists is not None:
+            for key, value, items in self._lists:
+                if (self.get(key) is value and
+                        not _same_items(value, items)):
+                    self._mark_changed(key)
+        return self._changed
+
+    def _mark_changed(self, key):
+        if self._changed is _NO_CHANGES:
+            self._changed = set()
+        self._changed.add(key)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._slots[key])
+        except KeyError:
+            if self._extra is None:
+                raise
+            return self._extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if (self._changed is not None and key not in _INTERNAL_FIELDS and
+                self.get(key, _MISSING) is not value):
+            self._mark_changed(key)
+        try:
+            setattr(self, self._slots[key], value)
+        except KeyError:
+            if self._extra is None:
+                self._extra = collections.OrderedDict()
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self._changed is not None and key not in _INTERNAL_FIELDS:
+            self._mark_changed(key)
+        try:
+            delattr(self, self._slots[key])
+        except KeyError:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        slot = self._slots.get(key)
+        if slot is not None:
+            return hasattr(self, slot)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        slot = self._slots.get(key)
+        if slot is not None:
+            return getattr(self, slot, default)
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+    def __iter__(self):
+        for field, slot in self._slot_items:
+            if hasattr(self, slot):
+                yield field
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for _key, value in self.iteritems():
+            yield value
+
+    def iteritems(self):
+        for field, slot in self._slot_items:
+            value = getattr(self, slot, _MISSING)
+            if value is not _MISSING:
+                yield field, value
+        if self._extra is not None:
+            for item in self._extra.iteritems():
+                yield item
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def to_dict(self):
+        res = {}
+        for field, slot in self._slot_items:
+            try:
+                res[field] = getattr(self, slot)
+            except AttributeError:
+                pass
+        if self._extra is not None:
+            res.update(self._extra)
+        return res
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def copy(self):
+        return self.__class__(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict, collections.Mapping)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.items())
+
+    def __reduce__(self):
+        return (_restore_record, (self._fields, self.items(), self.changed))
+
+
+collections.MutableMapping.register(Record)
+
+_RECORD_CLASSES = {}
+
+
+def record_class(fields):
+    ''' Returns the `Record` subclass with a slot for each of `fields`. '''
+    names = []
+    for field in tuple(fields) + ('__origin', '__unparsed'):
+        if isinstance(field, str):
+            field = intern(field)
+        if field not in names:
+            names.append(field)
+    names = tuple(names)
+    try:
+        return _RECORD_CLASSES[names]
+    except KeyError:
+        pass
+    slots = tuple('_f{}'.format(index) for index in xrange(len(names)))
+    cls = type('Record', (Record, ), {
+        '__slots__': slots,
+        '_fields': names,
+        '_slots': dict(zip(names, slots)),
+        '_slot_items': tuple(zip(names, slots)),
+    })
+    _RECORD_CLASSES[names] = cls
+    return cls
+
+
+def as_dict(values):
+    if isinstance(values, Record):
+        return values.to_dict()
+    return dict(values)
+
+
+def _restore_record(fields, items, changed):
+    try:
+        cls = _RECORD_CLASSES[fields]
+    except KeyError:
+        cls = record_class([f for f in fields if f not in _INTERNAL_FIELDS])
+    record = cls.from_dict(dict(items))
+    if changed is not None:
+        record.track_changes()
+    record._changed = changed  # pylint: disable=protected-access
+    return record
+
+
+def _same_items(values, items):
+    return len(values) == len(items) and all(
+        value is item for value, item in zip(values, items))
+
+
+def origin_bits(values):
+    ''' Returns the bits `values` was decoded from, or None. '''
+    origin = values.get('__origin')
+    if isinstance(origin, Span):
+        return origin.to_bits()
+    return origin
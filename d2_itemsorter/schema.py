@@ -7,132 +7,512 @@ import logging
 
 from pignacio_scripts.namedtuple import namedtuple_with_defaults
 
+from .bitstream import BitReader, BitWriter, Span, as_reader
 from .logger import Logger
-from .utils import bits_to_int, int_to_bits
+from .records import Record, as_dict, record_class
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
-class Integer(object):
-    def __init__(self, size):
-        self._size = size
+class BinaryType(object):
+    size = None
+
+    def read(self, reader, offset, **kwargs):
+        raise NotImplementedError()
+
+    def skip(self, reader, offset, **kwargs):
+        ''' Returns the offset right after the value starting at `offset`. '''
+        if self.size is not None:
+            return offset + self.size
+        return self.read(reader, offset, **kwargs)[1]
+
+    def write(self, writer, val, **kwargs):
+        raise NotImplementedError()
 
     def from_bits(self, bits, **kwargs):
-        bits = bits[:self._size][::-1]
-        return bits_to_int(bits), self._size
+        return self.read(as_reader(bits), 0, **kwargs)
 
     def to_bits(self, val, **kwargs):
+        writer = BitWriter()
+        self.write(writer, val, **kwargs)
+        return writer.to_bits()
+
+
+def _write_chars(writer, chars, char_size):
+    for char in chars:
+        value = ord(char)
+        # Values that do not fit in a single char are padded to a multiple of
+        # `char_size`, as `utils.int_to_bits` does
+        size = max(-(-value.bit_length() // char_size), 1) * char_size
+        writer.write(value, size)
+
+
+class Integer(BinaryType):
+    def __init__(self, size):
+        self._size = size
+
+    @property
+    def size(self):
+        return self._size
+
+    def read(self, reader, offset, **kwargs):
+        return reader.read_int(offset, self._size), offset + self._size
+
+    def write(self, writer, val, **kwargs):
+        if not isinstance(val, (int, long)):
+            raise ValueError("Value must be an integer: {!r}".format(val))
+        if val < 0:
+            raise ValueError("Value must be positive: {}".format(val))
         if val >= 2**self._size:
             raise ValueError("Value does not fit in {} bits: {}".format(
                 self._size, val))
-        return int_to_bits(val, self._size)[::-1]
+        writer.write(val, self._size)
+
+    def from_int(self, value):  # pylint: disable=no-self-use
+        return value
+
+    def to_int(self, val):
+        if isinstance(val, (int, long)) and 0 <= val < 2**self._size:
+            return val
+        return None
 
 
-class Nothing(object):
+class Nothing(BinaryType):
     def __init__(self, size):
         self._size = size
 
-    def from_bits(self, bits, **kwargs):
-        return bits[:self._size], self._size
+    @property
+    def size(self):
+        return self._size
 
-    def to_bits(self, val, **kwargs):
-        return val[:self._size]
+    def read(self, reader, offset, **kwargs):
+        end = offset + self._size
+        return reader.to_bits(offset, end), end
 
+    def write(self, writer, val, **kwargs):
+        writer.write_bits(val[:self._size])
 
-class Chars(object):
-    def __init__(self, count, char_size=8):
-        self._count = count
-        self._char_size = char_size
+    def from_int(self, value):
+        return format(value, '0{}b'.format(self._size))[::-1]
 
-    def from_bits(self, bits, **kwargs):
-        values = [bits[i * self._char_size:(i + 1) * self._char_size][::-1]
-                  for i in xrange(self._count)]
-        chars = [chr(bits_to_int(v)) for v in values if v]
-        return "".join(chars), self._count * self._char_size
+    def to_int(self, val):
+        if len(val) < self._size:
+            return None
+        return int(val[:self._size][::-1], 2)
 
-    def to_bits(self, chars, **kwargs):
-        values = [int_to_bits(
-            ord(c),
-            padding=self._char_size)[::-1] for c in chars]
-        return "".join(values)
 
+class Chars(BinaryType):
+    def __init__(self, count, char_size=8):
+        self._count = count
+        self._char_size = char_size
 
-class NullTerminatedChars(object):
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def char_size(self):
+        return self._char_size
+
+    @property
+    def size(self):
+        return self._count * self._char_size
+
+    def read(self, reader, offset, **kwargs):
+        chars = []
+        position = offset
+        for _ in xrange(self._count):
+            if position >= len(reader):
+                break
+            chars.append(chr(reader.read_int(position, self._char_size)))
+            position += self._char_size
+        return "".join(chars), offset + self._count * self._char_size
+
+    def write(self, writer, chars, **kwargs):
+        _write_chars(writer, chars, self._char_size)
+
+    def from_int(self, value):
+        mask = (1 << self._char_size) - 1
+        return "".join(chr((value >> (i * self._char_size)) & mask)
+                       for i in xrange(self._count))
+
+    def to_int(self, chars):
+        if len(chars) != self._count:
+            return None
+        value = 0
+        for index, char in enumerate(chars):
+            char_value = ord(char)
+            if char_value >> self._char_size:
+                return None
+            value |= char_value << (index * self._char_size)
+        return value
+
+
+class NullTerminatedChars(BinaryType):
     def __init__(self, char_size=8):
         self._char_size = char_size
 
-    def from_bits(self, bits, **kwargs):
-        count = 0
-        null = "0" * self._char_size
-
-        def _next():
-            return bits[self._char_size * count:self._char_size * (count + 1)]
-
-        while _next() not in ('', null):
-            count += 1
-
-        values = [bits[i * self._char_size:(i + 1) * self._char_size][::-1]
-                  for i in xrange(count)]
-        chars = [chr(bits_to_int(v)) for v in values if v]
-        return "".join(chars), (count + 1) * self._char_size
+    def read(self, reader, offset, **kwargs):
+        chars = []
+        position = offset
+        while position < len(reader):
+            value = reader.read_int(position, self._char_size)
+            position += self._char_size
+            if not value and position <= len(reader):
+                break
+            chars.append(chr(value))
+        else:
+            position += self._char_size
+        return "".join(chars), position
 
-    def to_bits(self, chars, **kwargs):
-        values = [int_to_bits(
-            ord(c),
-            padding=self._char_size)[::-1] for c in chars]
-        return "".join(values) + "0" * self._char_size
+    def write(self, writer, chars, **kwargs):
+        _write_chars(writer, chars, self._char_size)
+        writer.write(0, self._char_size)
 
 
-class Until(object):
+class Until(BinaryType):
     def __init__(self, patterns):
         self._patterns = patterns
 
-    def from_bits(self, bits, **kwargs):
-        def get_index(pattern, bits):
-            try:
-                return bits.index(pattern)
-            except ValueError:
-                return len(bits)
-
-        min_index = min(get_index(p, bits) for p in self._patterns)
+    def read(self, reader, offset, **kwargs):
+        end = self.skip(reader, offset)
+        return reader.to_bits(offset, end), end
 
-        return bits[:min_index], min_index
+    def skip(self, reader, offset, **kwargs):
+        end = len(reader)
+        for pattern in self._patterns:
+            # Later patterns only need to be looked for up to the earlier ones
+            index = reader.find_indexed(pattern, offset, end)
+            if index >= 0:
+                end = index
+        return end
 
-    def to_bits(self, val, **kwargs):  # pylint: disable=no-self-use
-        return val
+    def write(self, writer, val, **kwargs):  # pylint: disable=no-self-use
+        writer.write_bits(val)
 
 
 SchemaPiece = namedtuple_with_defaults(
     'SchemaPiece',
-    ['field', 'type', 'condition', 'multiple'],
+    ['field', 'type', 'condition', 'multiple', 'lazy'],
     defaults={'condition': None,
-              'multiple': None})
+              'multiple': None,
+              'lazy': False})
 
 
 class ParseError(Exception):
     pass
 
 
-class BinarySchema(object):
+class ParentCondition(object):  # pylint: disable=too-few-public-methods
+    ''' Piece condition that only depends on the parent record. '''
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, values):
+        return self.func(values[BinarySchema.PARENT_FIELD])
+
+
+def is_parent_condition(condition):
+    if isinstance(condition, basestring):
+        return condition.startswith('..')
+    return isinstance(condition, ParentCondition)
+
+
+def resolve_parent_conditions(schema, parent):
+    ''' Returns the pieces of `schema` parsed under `parent`. '''
+    scope = {BinarySchema.PARENT_FIELD: parent}
+    res = []
+    for piece in schema:
+        if is_parent_condition(piece.condition):
+            if not BinarySchema._should_parse(piece, scope):
+                continue
+            piece = piece._replace(condition=None)
+        res.append(piece)
+    return res
+
+
+def piece_type(piece):
+    if isinstance(piece.type, (int, long)):
+        return Nothing(piece.type)
+    return piece.type
+
+
+_PENDING = object()
+
+
+class LazyValue(object):
+    ''' Value of a lazy piece, decoded the first time it is used. '''
+
+    def __init__(self, type_, reader, start, end, **kwargs):
+        self._type = type_
+        self._reader = reader
+        self._start = start
+        self._end = end
+        self._kwargs = kwargs
+        self._value = _PENDING
+
+    @property
+    def span(self):
+        return self._start, self._end
+
+    @property
+    def decoded(self):
+        return self._value is not _PENDING
+
+    @property
+    def value(self):
+        if self._value is _PENDING:
+            self._value = self._type.read(self._reader, self._start,
+                                          **self._kwargs)[0]
+        return self._value
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.value, name)
+
+    def __repr__(self):
+        if self.decoded:
+            return repr(self._value)
+        return '<{} [{}:{}]>'.format(self.__class__.__name__, self._start,
+                                     self._end)
+
+    def write(self, writer, **kwargs):
+        # The layout of a record may depend on its parent, which may have
+        # changed, so records are decoded and left to `BinarySchema.write`
+        if self.decoded or isinstance(self, LazyRecord):
+            self._type.write(writer, self.value, **kwargs)
+        else:
+            writer.copy(self._reader, self._start, self._end)
+
+
+class LazyRecord(LazyValue, collections.MutableMapping):
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __setitem__(self, key, value):
+        self.value[key] = value
+
+    def __delitem__(self, key):
+        del self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+
+def _lazy_value(type_, reader, position, **kwargs):
+    end = type_.skip(reader, position, **kwargs)
+    lazy_class = LazyRecord if isinstance(type_, BinarySchema) else LazyValue
+    return lazy_class(type_, reader, position, end, **kwargs), end
+
+
+def write_value(type_, writer, value, **kwargs):
+    if isinstance(value, LazyValue):
+        value.write(writer, **kwargs)
+    else:
+        type_.write(writer, value, **kwargs)
+
+
+def is_unchanged(value):
+    ''' Returns whether `value` and the records in it are unchanged. '''
+    if isinstance(value, Record):
+        changed = value.changed
+        return changed is not None and not changed and all(
+            is_unchanged(v) for v in value.itervalues()
+            if isinstance(v, _NESTED_TYPES))
+    if isinstance(value, dict):
+        return False
+    if isinstance(value, list):
+        return all(is_unchanged(v) for v in value
+                   if isinstance(v, _NESTED_TYPES))
+    if isinstance(value, LazyValue):
+        return not value.decoded or is_unchanged(value.value)
+    return True
+
+
+_NESTED_TYPES = (Record, dict, list, LazyValue)
+
+
+def fixed_offsets(schema):
+    ''' Returns `{field: (offset, type)}` for the leading fixed pieces. '''
+    res = {}
+    offset = 0
+    for piece in schema:
+        type_ = piece_type(piece)
+        if (piece.condition is not None or piece.multiple or
+                type_.size is None):
+            break
+        res[piece.field] = (offset, type_)
+        offset += type_.size
+    return res
+
+
+class FixedRun(BinaryType):
+    ''' Consecutive fixed width pieces, read and written as a single int. '''
+
+    def __init__(self, pieces):
+        self.pieces = tuple(pieces)
+        self.fields = tuple(p.field for p in self.pieces)
+        self.types = tuple(piece_type(p) for p in self.pieces)
+        self.shifts = []
+        self.masks = []
+        size = 0
+        for type_ in self.types:
+            self.shifts.append(size)
+            self.masks.append((1 << type_.size) - 1)
+            size += type_.size
+        self._size = size
+        self._table = zip(self.types, self.shifts, self.masks)
+
+    @property
+    def size(self):
+        return self._size
+
+    def read(self, reader, offset, **kwargs):
+        if offset + self._size > len(reader):
+            return self._read_each(reader, offset)
+        word = reader.read_int(offset, self._size)
+        return ([type_.from_int((word >> shift) & mask)
+                 for type_, shift, mask in self._table],
+                offset + self._size)
+
+    def _read_each(self, reader, offset):
+        values = []
+        position = offset
+        for type_ in self.types:
+            if position > len(reader):
+                raise ParseError("EOD!")
+            value, position = type_.read(reader, position)
+            values.append(value)
+        return values, position
+
+    def pack(self, values):
+        ''' Returns `values` packed in an int, or None if they do not fit. '''
+        word = 0
+        for type_, shift, value in zip(self.types, self.shifts, values):
+            packed = type_.to_int(value)
+            if packed is None:
+                return None
+            word |= packed << shift
+        return word
+
+    def write(self, writer, values, **kwargs):
+        word = self.pack(values)
+        if word is None:
+            for type_, value in zip(self.types, values):
+                type_.write(writer, value)
+        else:
+            writer.write(word, self._size)
+
+
+_PACKABLE_TYPES = (Integer, Nothing, Chars)
+
+
+def group_fixed_runs(schema):
+    ''' Groups the runs of fixed width pieces of `schema` in `FixedRun`s. '''
+    res = []
+    run = []
+
+    def _flush():
+        if len(run) > 1:
+            res.append(SchemaPiece(tuple(p.field for p in run), FixedRun(run)))
+        else:
+            res.extend(run)
+        del run[:]
+
+    for piece in schema:
+        if (piece.condition is None and not piece.multiple and
+                not piece.lazy and
+                isinstance(piece_type(piece), _PACKABLE_TYPES)):
+            run.append(piece)
+        else:
+            _flush()
+            res.append(piece)
+    _flush()
+    return res
+
+
+class BinarySchema(BinaryType):
     UNPARSED_FIELD = '__unparsed'
     PARENT_FIELD = '__parent'
 
-    def __init__(self, schema):
-        self._schema = schema
-
-    def from_bits(self, binary_str, parent=None, **kwargs):
-        position = 0
-        res = collections.OrderedDict()
-        res[self.PARENT_FIELD] = parent
-        for piece in self._schema:
-            type_ = (Nothing(piece.type) if isinstance(piece.type, (int, long))
-                     else piece.type)
+    def __init__(self, schema, cache=None, layout=None):
+        self._schema = (schema if isinstance(schema, (list, tuple)) else
+                        list(schema))
+        self._cache = cache
+        self._layout = layout
+        self._layouts = {}
+        self._resolved = {}
+        self._plan = group_fixed_runs(self._schema)
+        self._record_class = record_class(p.field for p in self._schema)
+        self._offsets = fixed_offsets(self._schema)
+        self._conditional = [p for p in self._schema
+                             if p.condition is not None or
+                             callable(p.multiple)]
+        self._children = [(p.field, p.type, p.multiple) for p in self._schema
+                          if isinstance(p.type, BinarySchema)]
+
+    @property
+    def schema(self):
+        return self._schema
+
+    @property
+    def record_class(self):
+        return self._record_class
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def layout(self):
+        return self._layout
+
+    def layout_schema(self, parent):
+        ''' Returns the pieces read under `parent`. '''
+        return self._layout_entry(parent)[0]
+
+    def _layout_entry(self, parent):
+        if self._layout is None:
+            return self._schema, self._plan
+        key = self._layout(parent)
+        try:
+            return self._layouts[key]
+        except KeyError:
+            pass
+        schema = resolve_parent_conditions(self._schema, parent)
+        # Keys that resolve to the same pieces share them, and their plan
+        signature = tuple(schema)
+        try:
+            entry = self._resolved[signature]
+        except KeyError:
+            entry = self._resolved[signature] = (schema,
+                                                 group_fixed_runs(schema))
+        self._layouts[key] = entry
+        return entry
+
+    def read(self, reader, offset, parent=None, lazy=False, **kwargs):
+        if self._cache is not None and not lazy:
+            return self._cache.read(self._read, reader, offset, parent)
+        return self._read(reader, offset, parent, lazy)
+
+    def _read(self, reader, offset, parent=None, lazy=False):
+        position = offset
+        res = {self.PARENT_FIELD: parent}
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for piece in self._layout_entry(parent)[1]:
+            type_ = piece_type(piece)
             if self._should_parse(piece, res):
-                logger.debug("Parsing %s from position %s/%s", piece.field,
-                             position, len(binary_str))
-                logger.debug("Str: %s%s", binary_str[position:position + 50],
-                             '[...]'
-                             if len(binary_str) > position + 50 else '')
+                if debug:
+                    logger.debug("Parsing %s from position %s/%s",
+                                 piece.field, position, len(reader))
+                    logger.debug("Str: %s%s", reader[position:position + 50],
+                                 '[...]'
+                                 if len(reader) > position + 50 else '')
                 if piece.multiple:
                     if isinstance(piece.multiple, (int, long)):
                         count = piece.multiple
@@ -140,31 +520,44 @@ class BinarySchema(object):
                         count = piece.multiple(res)
                     values = []
                     for _ in xrange(count):
-                        if position >= len(binary_str):
+                        if position >= len(reader):
                             raise ParseError("EOD!")
-                        bits = binary_str[position:]
-                        value, advance = type_.from_bits(bits, parent=res)
-                        position += advance
+                        value, position = self._read_piece(
+                            piece, type_, reader, position, res, lazy)
                         values.append(value)
                     res[piece.field] = values
+                elif isinstance(type_, FixedRun):
+                    if position > len(reader):
+                        raise ParseError("EOD!")
+                    values, position = type_.read(reader, position)
+                    res.update(zip(piece.field, values))
                 else:
-                    if position > len(binary_str):
+                    if position > len(reader):
                         raise ParseError("EOD!")
-                    bits = binary_str[position:]
-                    res[piece.field], advance = type_.from_bits(bits, parent=res)
-                    position += advance
+                    res[piece.field], position = self._read_piece(
+                        piece, type_, reader, position, res, lazy)
 
-        res['__origin'] = binary_str[:position]
+        res['__origin'] = reader.span(offset, position)
         del res[self.PARENT_FIELD]
-        return res, position
-
-    def to_bits(self, values, parent=None, **kwargs):
-        res = ''
-        values = collections.OrderedDict(values)
+        record = self._record_class.from_dict(res)
+        record.track_changes()
+        return record, position
+
+    @staticmethod
+    def _read_piece(piece, type_, reader, position, parent, lazy):
+        if lazy and piece.lazy:
+            return _lazy_value(type_, reader, position, parent=parent,
+                               lazy=lazy)
+        return type_.read(reader, position, parent=parent, lazy=lazy)
+
+    def write(self, writer, values, parent=None, reuse=True, **kwargs):
+        ''' Encodes `values`, copying the `__origin` of unchanged records. '''
+        if reuse and self.write_origin(writer, values, parent):
+            return
+        values = as_dict(values)
         values[self.PARENT_FIELD] = parent
-        for piece in self._schema:
-            type_ = (Nothing(piece.type) if isinstance(piece.type, (int, long))
-                     else piece.type)
+        for piece in self._plan:
+            type_ = piece_type(piece)
             if self._should_parse(piece, values):
                 if piece.multiple:
                     if isinstance(piece.multiple, (int, long)):
@@ -176,21 +569,194 @@ class BinarySchema(object):
                             "Unexpected size for a multiple: {} (Expected {})",
                             len(values[piece.field]), count)
                     for value in values[piece.field]:
-                        res += type_.to_bits(value, parent=values)
+                        write_value(type_, writer, value, parent=values,
+                                    reuse=reuse)
+                elif isinstance(type_, FixedRun):
+                    type_.write(writer, [values[f] for f in piece.field])
+                else:
+                    write_value(type_, writer, values[piece.field],
+                                parent=values, reuse=reuse)
+
+    def read_fields(self, reader, offset, fields, parent=None):
+        ''' Like `read`, but only decodes the pieces in `fields`. '''
+        position = offset
+        res = {self.PARENT_FIELD: parent}
+        for piece in self._plan:
+            type_ = piece_type(piece)
+            if not self._should_parse(piece, res):
+                continue
+            if position > len(reader):
+                raise ParseError("EOD!")
+            if isinstance(type_, FixedRun):
+                values, position = type_.read(reader, position)
+                res.update(zip(piece.field, values))
+                continue
+            skipped = (piece.field not in fields and
+                       not isinstance(type_, _CONDITION_TYPES))
+            if piece.multiple:
+                if isinstance(piece.multiple, (int, long)):
+                    count = piece.multiple
                 else:
-                    res += type_.to_bits(values[piece.field], parent=values)
+                    count = piece.multiple(res)
+                values = []
+                for _ in xrange(count):
+                    if position >= len(reader):
+                        raise ParseError("EOD!")
+                    if skipped:
+                        position = type_.skip(reader, position, parent=res)
+                    else:
+                        value, position = self._read_field(
+                            piece, type_, reader, position, res, fields)
+                        values.append(value)
+            elif skipped:
+                position = type_.skip(reader, position, parent=res)
+            else:
+                values, position = self._read_field(piece, type_, reader,
+                                                     position, res, fields)
+            if not skipped:
+                res[piece.field] = values
+        del res[self.PARENT_FIELD]
+        return res, position
+
+    @staticmethod
+    def _read_field(piece, type_, reader, position, parent, fields):
+        subfields = fields.get(piece.field, {})
+        if subfields is not None and isinstance(type_, BinarySchema):
+            return type_.read_fields(reader, position, subfields,
+                                     parent=parent)
+        return type_.read(reader, position, parent=parent)
+
+    def projection(self, paths):
+        ''' Returns the tree of field names for the dotted `paths`. '''
+        fields = {}
+        for path in paths:
+            schema = self
+            node = fields
+            names = path.split('.')
+            for depth, name in enumerate(names):
+                piece = schema.piece(name)
+                if piece is None:
+                    raise ValueError("Unknown field {!r} in {!r}".format(
+                        name, path))
+                if depth == len(names) - 1:
+                    node[name] = None
+                    break
+                if name in node and node[name] is None:
+                    break
+                schema = piece_type(piece)
+                if not isinstance(schema, BinarySchema):
+                    raise ValueError("Field {!r} in {!r} has no fields".format(
+                        name, path))
+                node = node.setdefault(name, {})
+        return fields
+
+    def piece(self, field):
+        for piece in self._schema:
+            if piece.field == field:
+                return piece
+        return None
+
+    @classmethod
+    def project(cls, values, fields):
+        res = {}
+        for name, subfields in fields.items():
+            if name not in values:
+                continue
+            value = values[name]
+            if subfields is not None:
+                if isinstance(value, list):
+                    value = [cls.project(v, subfields) for v in value]
+                else:
+                    value = cls.project(value, subfields)
+            res[name] = value
         return res
 
-    def decode(self, binary_str):
-        res, position = self.from_bits(binary_str)
-        unparsed = binary_str[position:]
+    def write_origin(self, writer, values, parent=None):
+        ''' Copies the `__origin` of `values`, returning whether it could. '''
+        if not isinstance(values, Record) or values.changed is None:
+            return False
+        origin = values.get('__origin')
+        if origin is None:
+            return False
+        patches = []
+        for field in values.changed:
+            if field not in self._offsets or field not in values:
+                return False
+            offset, type_ = self._offsets[field]
+            packed = type_.to_int(values[field])
+            if packed is None:
+                return False
+            patches.append((offset, type_.size, packed))
+        children = []
+        for field, type_, multiple in self._children:
+            if field not in values:
+                continue
+            for child in values[field] if multiple else [values[field]]:
+                if isinstance(child, LazyValue):
+                    child = child.value
+                if not is_unchanged(child):
+                    return False
+                children.append((type_, child))
+        scope = self._layout_scope(values, parent)
+        if scope is None:
+            return False
+        for type_, child in children:
+            if type_._layout_scope(child, scope) is None:
+                return False
+        if not isinstance(origin, Span):
+            origin = BitReader.from_bits(origin).span(0, len(origin))
+        position = 0
+        for offset, size, packed in sorted(patches):
+            origin.write(writer, position, offset)
+            writer.write(packed, size)
+            position = offset + size
+        origin.write(writer, position)
+        return True
+
+    def _layout_scope(self, values, parent):
+        scope = as_dict(values)
+        scope[self.PARENT_FIELD] = parent
+        for piece in self._conditional:
+            present = piece.field in scope
+            if (piece.condition is not None and
+                    bool(self._should_parse(piece, scope)) != present):
+                return None
+            if (present and callable(piece.multiple) and
+                    piece.multiple(scope) != len(scope[piece.field])):
+                return None
+        return scope
+
+    def decode(self, data, lazy=False, fields=None):
+        '''
+        Decodes `data`. Lazy pieces are decoded on use if `lazy` is set, and
+        only the dotted paths in `fields` are decoded if given.
+        '''
+        reader = data if isinstance(data, BitReader) else BitReader(data)
+        if fields is not None:
+            fields = self.projection(fields)
+            return self.project(self.read_fields(reader, 0, fields)[0],
+                                fields)
+        res, position = self.read(reader, 0, lazy=lazy)
+        unparsed = reader.to_bits(position)
         if unparsed:
             res[self.UNPARSED_FIELD] = unparsed
         return res
 
-    def encode(self, values):
-        res = self.to_bits(values)
-        return res + values.get(self.UNPARSED_FIELD, '')
+    def encode(self, values, reuse=True):
+        writer = BitWriter()
+        self.write(writer, values, reuse=reuse)
+        writer.write_bits(values.get(self.UNPARSED_FIELD, ''))
+        return writer.getvalue()
+
+    def encode_to(self, values, outputs, reuse=True):
+        ''' Same as `encode`, but writes the bytes to `outputs`. '''
+        if not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+        writer = BitWriter(outputs)
+        self.write(writer, values, reuse=reuse)
+        writer.write_bits(values.get(self.UNPARSED_FIELD, ''))
+        writer.finish()
+        return len(writer) // 8
 
     @classmethod
     def _should_parse(cls, piece, values):
@@ -202,3 +768,7 @@ class BinarySchema(object):
             return values.get(piece.condition)
         else:
             return piece.condition(values)
+
+
+# Types that `BinarySchema.read_fields` decodes even when not asked to
+_CONDITION_TYPES = (Integer, Chars, BinarySchema)
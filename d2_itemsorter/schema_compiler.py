@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+
+import collections
+import functools
+import logging
+
+from .logger import Logger
+from .records import as_dict, record_class
+from .schema import (BinarySchema, Chars, FixedRun, Integer, LazyValue,
+                     Nothing, ParseError, group_fixed_runs, piece_type)
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CompiledFunctions = collections.namedtuple('CompiledFunctions',
+                                           ['read', 'write', 'source'])
+
+_COMPILED = {}
+
+
+def compile_schema(schema, debug=False):
+    ''' Returns the `CompiledFunctions` for `schema`, generated once. '''
+    key = (id(schema), debug)
+    try:
+        return _COMPILED[key][1]
+    except KeyError:
+        pass
+    compiled = _SchemaCompiler(list(schema), debug).compile()
+    # The schema is kept alive alongside the result so its id is not reused
+    _COMPILED[key] = (schema, compiled)
+    return compiled
+
+
+class CompiledSchema(BinarySchema):
+    ''' `BinarySchema` that decodes and encodes through `compile_schema`. '''
+
+    def read(self, reader, offset, parent=None, lazy=False, **kwargs):
+        if lazy:
+            return super(CompiledSchema, self).read(reader, offset, parent,
+                                                    lazy=lazy)
+        read = self._compiled(self.layout_schema(parent)).read
+        if self.cache is not None:
+            return self.cache.read(read, reader, offset, parent)
+        return read(reader, offset, parent)
+
+    def write(self, writer, values, parent=None, reuse=True, **kwargs):
+        if not reuse:
+            return super(CompiledSchema, self).write(writer, values, parent,
+                                                     reuse=reuse)
+        # Conditions are checked per record, so the layout is not resolved
+        return self._compiled(self.schema).write(writer, values, parent)
+
+    @staticmethod
+    def _compiled(schema):
+        return compile_schema(schema, debug=logger.isEnabledFor(logging.DEBUG))
+
+
+def _layout_read(schema, debug):
+    if schema.layout is None:
+        return compile_schema(schema.schema, debug).read
+
+    def read(reader, offset, parent=None):
+        return compile_schema(schema.layout_schema(parent), debug).read(
+            reader, offset, parent)
+
+    return read
+
+
+class _Source(object):
+    def __init__(self):
+        self._lines = []
+        self._indent = 0
+
+    def add(self, line, *args):
+        self._lines.append('    ' * self._indent + line.format(*args))
+
+    def block(self, line, *args):
+        self.add(line, *args)
+        return _Block(self)
+
+    def text(self):
+        return '\n'.join(self._lines) + '\n'
+
+
+class _Block(object):  # pylint: disable=too-few-public-methods
+    def __init__(self, source):
+        self._source = source
+        self._source._indent += 1  # pylint: disable=protected-access
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._source._indent -= 1  # pylint: disable=protected-access
+
+
+class _SchemaCompiler(object):
+    def __init__(self, schema, debug):
+        self._schema = schema
+        self._plan = group_fixed_runs(schema)
+        self._debug = debug
+        self._namespace = {
+            'from_dict': record_class(p.field for p in schema).from_dict,
+            'as_dict': as_dict,
+            'write_origin': BinarySchema(schema).write_origin,
+            'ParseError': ParseError,
+            'Logger': Logger,
+            'INT_TYPES': (int, long),
+            'LazyValue': LazyValue,
+            'logger': logger,
+        }
+
+    def compile(self):
+        source = _Source()
+        self._read_function(source)
+        self._write_function(source)
+        text = source.text()
+        code = compile(text, '<compiled schema {:#x}>'.format(
+            id(self._schema)), 'exec')
+        exec code in self._namespace  # pylint: disable=exec-used
+        return CompiledFunctions(self._namespace['read'],
+                                 self._namespace['write'], text)
+
+    def _bind(self, prefix, index, value):
+        name = '{}{}'.format(prefix, index)
+        self._namespace[name] = value
+        return name
+
+    def _condition(self, index, piece, values):
+        condition = piece.condition
+        if condition is None:
+            return None
+        if isinstance(condition, basestring):
+            if condition.startswith('..'):
+                return 'parent.get({!r})'.format(condition[2:])
+            return '{}.get({!r})'.format(values, condition)
+        return '{}({})'.format(self._bind('cond', index, condition), values)
+
+    def _count(self, index, piece, values):
+        if isinstance(piece.multiple, (int, long)):
+            return repr(piece.multiple)
+        return '{}({})'.format(self._bind('count', index, piece.multiple),
+                               values)
+
+    def _read_function(self, src):
+        src.add('def read(reader, offset, parent=None):')
+        with _Block(src):
+            src.add('read_int = reader.read_int')
+            src.add('to_bits = reader.to_bits')
+            src.add('end = len(reader)')
+            src.add('position = offset')
+            src.add('res = {{{!r}: parent}}', BinarySchema.PARENT_FIELD)
+            for index, piece in enumerate(self._plan):
+                condition = self._condition(index, piece, 'res')
+                if condition is None:
+                    self._read_piece(src, index, piece)
+                else:
+                    with src.block('if {}:', condition):
+                        self._read_piece(src, index, piece)
+            src.add("res['__origin'] = reader.span(offset, position)")
+            src.add('del res[{!r}]', BinarySchema.PARENT_FIELD)
+            src.add('record = from_dict(res)')
+            src.add('record.track_changes()')
+            src.add('return record, position')
+        src.add('')
+
+    def _read_piece(self, src, index, piece):
+        if self._debug:
+            src.add('logger.debug("Parsing %s from position %s/%s", {!r}, '
+                    'position, end)', piece.field)
+            src.add('logger.debug("Str: %s%s", reader[position:position + 50],'
+                    ' "[...]" if end > position + 50 else "")')
+        if piece.multiple:
+            src.add('count = {}', self._count(index, piece, 'res'))
+            src.add('values = []')
+            with src.block('for _ in xrange(count):'):
+                with src.block('if position >= end:'):
+                    src.add('raise ParseError("EOD!")')
+                self._read_value(src, index, piece, 'value')
+                src.add('values.append(value)')
+            src.add('res[{!r}] = values', piece.field)
+        elif isinstance(piece.type, FixedRun):
+            self._read_run(src, index, piece.type)
+        else:
+            with src.block('if position > end:'):
+                src.add('raise ParseError("EOD!")')
+            self._read_value(src, index, piece,
+                             'res[{!r}]'.format(piece.field))
+
+    def _read_run(self, src, index, run):
+        with src.block('if position + {} <= end:', run.size):
+            src.add('word = read_int(position, {})', run.size)
+            for field, type_, shift, mask in zip(run.fields, run.types,
+                                                 run.shifts, run.masks):
+                src.add('res[{!r}] = {}', field,
+                        self._unpack_expression(index, type_, shift, mask))
+            src.add('position += {}', run.size)
+        with src.block('else:'):
+            # Near the end of the data, fall back to reading field by field
+            src.add('values, position = {}(reader, position)',
+                    self._bind('read', index, run.read))
+            for field_no, field in enumerate(run.fields):
+                src.add('res[{!r}] = values[{}]', field, field_no)
+
+    def _unpack_expression(self, index, type_, shift, mask):
+        value = ('word >> {} & {:#x}'.format(shift, mask) if shift else
+                 'word & {:#x}'.format(mask))
+        if isinstance(type_, Integer):
+            return value
+        if isinstance(type_, Nothing):
+            return "format({}, '0{}b')[::-1]".format(value, type_.size)
+        if isinstance(type_, Chars):
+            return ' + '.join(
+                'chr(word >> {} & {:#x})'.format(
+                    shift + char * type_.char_size, (1 << type_.char_size) - 1)
+                for char in xrange(type_.count)) or "''"
+        return '{}({})'.format(
+            self._bind('from_int{}_'.format(index), shift, type_.from_int),
+            value)
+
+    def _read_value(self, src, index, piece, target):
+        type_ = piece_type(piece)
+        if isinstance(type_, Integer):
+            src.add('{} = read_int(position, {})', target, type_.size)
+            src.add('position += {}', type_.size)
+        elif isinstance(type_, Nothing):
+            src.add('{} = to_bits(position, position + {})', target,
+                    type_.size)
+            src.add('position += {}', type_.size)
+        elif isinstance(type_, BinarySchema):
+            read = _layout_read(type_, self._debug)
+            if type_.cache is not None:
+                read = functools.partial(type_.cache.read, read)
+            name = self._bind('read', index, read)
+            src.add('{}, position = {}(reader, position, res)', target, name)
+        else:
+            name = self._bind('read', index, type_.read)
+            src.add('{}, position = {}(reader, position, parent=res)',
+                    target, name)
+
+    def _write_function(self, src):
+        src.add('def write(writer, values, parent=None):')
+        with _Block(src):
+            with src.block('if write_origin(writer, values, parent):'):
+                src.add('return None')
+            src.add('values = as_dict(values)')
+            src.add('values[{!r}] = parent', BinarySchema.PARENT_FIELD)
+            src.add('write = writer.write')
+            src.add('write_bits = writer.write_bits')
+            for index, piece in enumerate(self._plan):
+                condition = self._condition(index, piece, 'values')
+                if condition is None:
+                    self._write_piece(src, index, piece)
+                else:
+                    with src.block('if {}:', condition):
+                        self._write_piece(src, index, piece)
+            src.add('return None')
+        src.add('')
+
+    def _write_piece(self, src, index, piece):
+        if piece.multiple:
+            src.add('items = values[{!r}]', piece.field)
+            src.add('count = {}', self._count(index, piece, 'values'))
+            with src.block('if len(items) != count:'):
+                src.add('Logger.warn("Unexpected size for a multiple: {{}} '
+                        '(Expected {{}})", len(items), count)')
+            with src.block('for value in items:'):
+                self._write_value(src, index, piece, 'value')
+        elif isinstance(piece.type, FixedRun):
+            src.add('{}(writer, [{}])',
+                    self._bind('write', index, piece.type.write),
+                    ', '.join('values[{!r}]'.format(f) for f in piece.field))
+        else:
+            src.add('value = values[{!r}]', piece.field)
+            self._write_value(src, index, piece, 'value')
+
+    def _write_value(self, src, index, piece, value):
+        type_ = piece_type(piece)
+        if piece.lazy:
+            # Lazy values that were never decoded are copied as they are
+            with src.block('if isinstance({}, LazyValue):', value):
+                src.add('{}.write(writer, parent=values)', value)
+            with src.block('else:'):
+                self._write_plain_value(src, index, type_, value)
+        else:
+            self._write_plain_value(src, index, type_, value)
+
+    def _write_plain_value(self, src, index, type_, value):
+        if isinstance(type_, Integer):
+            check = ('not (isinstance({0}, INT_TYPES) and 0 <= {0} < {1})'
+                     .format(value, 2**type_.size))
+            with src.block('if {}:', check):
+                # Let the type raise the appropriate error
+                src.add('{}(writer, {})',
+                        self._bind('write', index, type_.write), value)
+            src.add('write({}, {})', value, type_.size)
+        elif isinstance(type_, Nothing):
+            src.add('write_bits({}[:{}])', value, type_.size)
+        elif isinstance(type_, BinarySchema):
+            name = self._bind(
+                'write', index, compile_schema(type_.schema).write)
+            src.add('{}(writer, {}, values)', name, value)
+        else:
+            name = self._bind('write', index, type_.write)
+            src.add('{}(writer, {}, parent=values)', name, value)
@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+
+import collections
+import mmap
+import multiprocessing
+
+from .bitstream import BitReader, BitWriter
+from .decode_cache import DecodeCache
+from .items import item_has_defense, item_has_quantity, item_has_durability
+from .logger import Logger
+from .props import INTERNED_PROPERTIES, PropertyList
+from .records import Record, as_dict
+from .schema import (SchemaPiece, Integer, Chars, BinarySchema,
+                     ParentCondition, ParseError, Until, NullTerminatedChars,
+                     fixed_offsets, group_fixed_runs, is_unchanged)
+from .schema_compiler import CompiledSchema
+from .utils import str_to_bits
+
+_SHARED_STASH_HEADER = "\x53\x53\x53\x00\x30\x31"
+_STASH_HEADER = "\x43\x53\x54\x4d\x30\x31"
+_PAGE_HEADER = str_to_bits("\x53\x54\x00\x4a\x4d")
+_ITEM_HEADER = str_to_bits("\x4a\x4d")
+
+_ITEMS_WITHOUT_PROPERTIES = set()
+
+
+def _item_has_defense(parent):
+    return item_has_defense(parent['item_type'])
+
+
+def _item_has_durability(parent):
+    return item_has_durability(parent['item_type'])
+
+
+def _item_has_quantity(parent):
+    return item_has_quantity(parent['item_type'])
+
+
+def _item_has_properties(parent):
+    return parent['item_type'] not in _ITEMS_WITHOUT_PROPERTIES
+
+
+def _is_set_item(parent):
+    return parent['extended_info']['quality'] == 5
+
+
+def _specific_item_layout(parent):
+    return (parent['item_type'], parent['extended_info']['quality'],
+            parent['socketed'])
+
+
+_SPECIFIC_ITEM_SCHEMA = [
+    SchemaPiece(
+        'defense',
+        Integer(11),
+        condition=ParentCondition(_item_has_defense)),
+    SchemaPiece(
+        'max_durability',
+        Integer(9),
+        condition=ParentCondition(_item_has_durability)),
+    SchemaPiece(
+        'current_durability',
+        Integer(9),
+        condition='max_durability'),
+    SchemaPiece(
+        'num_sockets',
+        Integer(4),
+        condition='..socketed'),
+    SchemaPiece(
+        'quantity',
+        Integer(9),
+        condition=ParentCondition(_item_has_quantity)),
+    SchemaPiece('has_set_props_1', Integer(1),
+                condition=ParentCondition(_is_set_item)),
+    SchemaPiece('has_set_props_2', Integer(1),
+                condition=ParentCondition(_is_set_item)),
+    SchemaPiece('has_set_props_3', Integer(1),
+                condition=ParentCondition(_is_set_item)),
+    SchemaPiece('has_set_props_4', Integer(1),
+                condition=ParentCondition(_is_set_item)),
+    SchemaPiece('has_set_props_5', Integer(1),
+                condition=ParentCondition(_is_set_item)),
+    SchemaPiece('properties', PropertyList(),
+                condition=ParentCondition(_item_has_properties),
+                lazy=True),
+    SchemaPiece('set_props_1', PropertyList(), condition='has_set_props_1',
+                lazy=True),
+    SchemaPiece('set_props_2', PropertyList(), condition='has_set_props_2',
+                lazy=True),
+    SchemaPiece('set_props_3', PropertyList(), condition='has_set_props_3',
+                lazy=True),
+    SchemaPiece('set_props_4', PropertyList(), condition='has_set_props_4',
+                lazy=True),
+    SchemaPiece('set_props_5', PropertyList(), condition='has_set_props_5',
+                lazy=True),
+]  # yapf: disable
+
+_EXTENDED_ITEM_SCHEMA = [
+    SchemaPiece('gem_count', Integer(3)),
+    SchemaPiece('guid', 32),
+    SchemaPiece('drop_level', Integer(7)),
+    SchemaPiece('quality', Integer(4)),
+    SchemaPiece('has_gfx', Integer(1)),
+    SchemaPiece('gfx', Integer(3), condition='has_gfx'),
+    SchemaPiece('has_class_info', Integer(1)),
+    SchemaPiece('class_info', 11, condition='has_class_info'),
+    SchemaPiece('lo_qual_type', Integer(3),
+                condition=lambda v: v['quality'] == 1),
+    SchemaPiece('hi_qual_type', Integer(3),
+                condition=lambda v: v['quality'] == 3),
+    SchemaPiece('magic_prefix', Integer(11),
+                condition=lambda v: v['quality'] == 4),
+    SchemaPiece('magic_suffix', Integer(11),
+                condition=lambda v: v['quality'] == 4),
+    SchemaPiece('set_id', Integer(12),
+                condition=lambda v: v['quality'] == 5),
+    SchemaPiece('rare_name_1', Integer(8),
+                condition=lambda v: v['quality'] in (6, 8,)),
+    SchemaPiece('rare_name_2', Integer(8),
+                condition=lambda v: v['quality'] in (6, 8,)),
+    SchemaPiece('has_prefix_1', Integer(1),
+                condition=lambda v: v['quality'] in (6, 8,)),
+    SchemaPiece('prefix_1', Integer(11),
+                condition='has_prefix_1'),
+    SchemaPiece('has_suffix_1', Integer(1),
+                condition=lambda v: v['quality'] in (6, 8,)),
+    SchemaPiece('suffix_1', Integer(11),
+                condition='has_suffix_1'),
+    SchemaPiece('has_prefix_2', Integer(1),
+                condition=lambda v: v['quality'] in (6, 8,)),
+    SchemaPiece('prefix_2', Integer(11),
+                condition='has_prefix_2'),
+    SchemaPiece('has_suffix_2', Integer(1),
+                condition=lambda v: v['quality'] in (6, 8,)),
+    SchemaPiece('suffix_2', Integer(11),
+                condition='has_suffix_2'),
+    SchemaPiece('has_prefix_3', Integer(1),
+                condition=lambda v: v['quality'] in (6, 8,)),
+    SchemaPiece('prefix_3', Integer(11),
+                condition='has_prefix_3'),
+    SchemaPiece('has_suffix_3', Integer(1),
+                condition=lambda v: v['quality'] in (6, 8,)),
+    SchemaPiece('suffix_3', Integer(11),
+                condition='has_suffix_3'),
+    SchemaPiece('unique_id', Integer(12),
+                condition=lambda v: v['quality'] == 7),
+    SchemaPiece('runeword', Integer(16),
+                condition='..has_runeword'),
+    SchemaPiece('runeword', NullTerminatedChars(7),
+                condition='..inscribed'),
+]  # yapf: disable
+
+
+_ITEM_DATA_SCHEMA = [
+    SchemaPiece('header', Chars(2)),
+    SchemaPiece('_unk1', 4),
+    SchemaPiece('identified', Integer(1)),
+    SchemaPiece('_unk2', 6),
+    SchemaPiece('socketed', Integer(1)),
+    SchemaPiece('_unk3', 9),
+    SchemaPiece('simple', Integer(1)),
+    SchemaPiece('ethereal', Integer(1)),
+    SchemaPiece('_unk4', 1),
+    SchemaPiece('inscribed', Integer(1)),
+    SchemaPiece('_unk5', 1),
+    SchemaPiece('has_runeword', Integer(1)),
+    SchemaPiece('_unk6', 22),
+    SchemaPiece('position_x', Integer(4)),
+    SchemaPiece('position_y', Integer(4)),
+    SchemaPiece('_unk7', 3),
+    SchemaPiece('item_type', Chars(4)),
+    SchemaPiece(
+        'extended_info',
+        BinarySchema(_EXTENDED_ITEM_SCHEMA),
+        condition=lambda v: not v['simple']),
+    SchemaPiece('has_random_pad', Integer(1)),
+    SchemaPiece('random_pad', Integer(96), condition='has_random_pad'),
+    SchemaPiece(
+        'specific_info',
+        BinarySchema(_SPECIFIC_ITEM_SCHEMA, layout=_specific_item_layout),
+        condition=lambda v: not v['simple'],
+        lazy=True),
+    SchemaPiece('tail', Until([_ITEM_HEADER, _PAGE_HEADER]))
+]  # yapf: disable
+
+_ITEM_OFFSETS = fixed_offsets(_ITEM_DATA_SCHEMA)
+_ITEM_POSITION_FIELDS = ('position_x', 'position_y')
+_ITEM_POSITION_START = min(_ITEM_OFFSETS[f][0] for f in _ITEM_POSITION_FIELDS)
+_ITEM_POSITION_END = max(_ITEM_OFFSETS[f][0] + _ITEM_OFFSETS[f][1].size
+                         for f in _ITEM_POSITION_FIELDS)
+_ITEM_TAIL = Until([_ITEM_HEADER, _PAGE_HEADER])
+
+
+def _simple_item_key(reader, offset):
+    if not reader.read_int(offset + _ITEM_OFFSETS['simple'][0], 1):
+        return None
+    end = _ITEM_TAIL.skip(reader, offset + 1)
+    if end - offset <= _ITEM_POSITION_END:
+        return None
+    key = (reader.read_int(offset, _ITEM_POSITION_START),
+           reader.read_int(offset + _ITEM_POSITION_END,
+                           end - offset - _ITEM_POSITION_END),
+           end - offset)
+    return key, end
+
+
+ITEM_DECODE_CACHE = DecodeCache(
+    _simple_item_key,
+    refresh={f: _ITEM_OFFSETS[f] for f in _ITEM_POSITION_FIELDS})
+
+
+_ITEM_RUN = group_fixed_runs(_ITEM_DATA_SCHEMA)[0].type
+_SIMPLE_SHIFT = _ITEM_RUN.shifts[_ITEM_RUN.fields.index('simple')]
+_RANDOM_PAD_SIZE = BinarySchema(
+    _ITEM_DATA_SCHEMA).piece('random_pad').type.size
+
+
+_ITEM_SCHEMA = [
+    SchemaPiece('item', BinarySchema(_ITEM_DATA_SCHEMA,
+                                     cache=ITEM_DECODE_CACHE)),
+    SchemaPiece(
+        'gems',
+        BinarySchema(_ITEM_DATA_SCHEMA, cache=ITEM_DECODE_CACHE),
+        multiple=lambda v: v['item'].get('extended_info', {}).get('gem_count', 0)),
+]  # yapf: disable
+
+
+_PAGE_SCHEMA = [
+    SchemaPiece('header', Chars(5)),
+    SchemaPiece('item_count', Integer(16)),
+    SchemaPiece(
+        'items',
+        BinarySchema(_ITEM_SCHEMA),
+        multiple=lambda v: v['item_count']),
+]  # yapf: disable
+
+
+_PERSONAL_STASH_SCHEMA = [
+    SchemaPiece('header', Chars(6)),
+    SchemaPiece('_unk1', 32),
+    SchemaPiece('page_count', Integer(32)),
+    SchemaPiece(
+        'pages',
+        BinarySchema(_PAGE_SCHEMA),
+        multiple=lambda v: v['page_count']),
+]  # yapf: disable
+
+
+_SHARED_STASH_SCHEMA = [
+    SchemaPiece('header', Chars(6)),
+    SchemaPiece('page_count', Integer(32)),
+    SchemaPiece(
+        'pages',
+        BinarySchema(_PAGE_SCHEMA),
+        multiple=lambda v: v['page_count']),
+]  # yapf: disable
+
+
+PageIndex = collections.namedtuple('PageIndex', ['offset', 'end', 'items'])
+
+
+def _fixed_size(schema):
+    return max(offset + type_.size
+               for offset, type_ in fixed_offsets(schema).values())
+
+
+def stash_schema(data):
+    if bytearray(data[:len(_SHARED_STASH_HEADER)]) == _SHARED_STASH_HEADER:
+        return _SHARED_STASH_SCHEMA
+    return _PERSONAL_STASH_SCHEMA
+
+
+def _item_end(reader, offset, item_schema):
+    if reader.read_int(offset + _SIMPLE_SHIFT, 1):
+        # Simple items have no gems and a fixed layout up to their tail
+        position = offset + _ITEM_RUN.size
+        if reader.read_int(position, 1):
+            position += _RANDOM_PAD_SIZE
+        return _ITEM_TAIL.skip(reader, position + 1)
+    return item_schema.read(reader, offset)[1]
+
+
+def _walk_stash(reader, read_item, pages=None):
+    '''
+    Yields `(page_no, item_no, offset, item, end)` for each item, and with
+    `item_no` None for each page after its items.
+    '''
+    schema = stash_schema(reader.data)
+    count_offset, count_type = fixed_offsets(schema)['page_count']
+    page_count = count_type.read(reader, count_offset)[0]
+    if pages is not None:
+        page_count = min(page_count, pages)
+    count_offset, count_type = fixed_offsets(_PAGE_SCHEMA)['item_count']
+    items_start = _fixed_size(_PAGE_SCHEMA)
+    position = _fixed_size(schema)
+    for page_no in xrange(page_count):
+        page_offset = position
+        item_count = count_type.read(reader, position + count_offset)[0]
+        position += items_start
+        for item_no in xrange(item_count):
+            if position >= len(reader):
+                raise ParseError("EOD!")
+            item, end = read_item(reader, position)
+            yield page_no, item_no, position, item, end
+            position = end
+        yield page_no, None, page_offset, None, position
+
+
+def index_stash(data, pages=None):
+    ''' Returns a `PageIndex` for each of the first `pages` pages. '''
+    reader = data if isinstance(data, BitReader) else BitReader(data)
+    item_schema = CompiledSchema(_ITEM_SCHEMA)
+
+    def read_item(reader, offset):
+        return None, _item_end(reader, offset, item_schema)
+
+    res = []
+    items = []
+    for _, item_no, offset, _, end in _walk_stash(reader, read_item, pages):
+        if item_no is None:
+            res.append(PageIndex(offset, end, items))
+            items = []
+        else:
+            items.append(offset)
+    return res
+
+
+def decode_page(data, page_no, index=None):
+    ''' Decodes page `page_no`, without decoding the pages before it. '''
+    reader = data if isinstance(data, BitReader) else BitReader(data)
+    if index is None:
+        index = index_stash(reader, pages=page_no + 1)
+    return BinarySchema(_PAGE_SCHEMA).read(reader, index[page_no].offset)[0]
+
+
+def decode_item(data, page_no, item_no, index=None):
+    ''' Decodes item `item_no` of page `page_no`, like `decode_page`. '''
+    reader = data if isinstance(data, BitReader) else BitReader(data)
+    if index is None:
+        index = index_stash(reader, pages=page_no + 1)
+    return BinarySchema(_ITEM_SCHEMA).read(
+        reader, index[page_no].items[item_no])[0]
+
+
+def _map_contents(source):
+    if not hasattr(source, 'read'):
+        return source
+    try:
+        return mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        # Not a real file (or an empty one), so it is read instead
+        return source.read()
+
+
+def iterdecode(source, compiled=False):
+    '''
+    Yields `(page_no, item_no, item)` for each item of `source`, one at a
+    time. A file mapped here is closed when the iteration ends.
+    '''
+    contents = _map_contents(source)
+    item_schema = (CompiledSchema if compiled else BinarySchema)(_ITEM_SCHEMA)
+    try:
+        reader = BitReader(contents, indexed=False)
+        for page_no, item_no, _, item, _ in _walk_stash(reader,
+                                                        item_schema.read):
+            if item_no is not None:
+                yield page_no, item_no, item
+    finally:
+        if contents is not source and isinstance(contents, mmap.mmap):
+            contents.close()
+
+
+def _decode_page_chunk(args):
+    chunk, compiled = args
+    schema_class = CompiledSchema if compiled else BinarySchema
+    hits, misses = ITEM_DECODE_CACHE.hits, ITEM_DECODE_CACHE.misses
+    interned = INTERNED_PROPERTIES.copy()
+    try:
+        result = schema_class(_PAGE_SCHEMA).read(BitReader(chunk), 0)
+    except ParseError:
+        result = None
+    # The parent merges what this page added to the worker counters
+    counters = (ITEM_DECODE_CACHE.hits - hits,
+                ITEM_DECODE_CACHE.misses - misses,
+                INTERNED_PROPERTIES - interned)
+    return result, counters
+
+
+def _chunk(data, start, end):
+    chunk = data[start:end]
+    return chunk.tobytes() if isinstance(chunk, memoryview) else chunk
+
+
+def decode_stash(data, jobs=1, compiled=False):
+    ''' Decodes `data`, splitting the pages among `jobs` processes. '''
+    schema = stash_schema(data)
+    schema_class = CompiledSchema if compiled else BinarySchema
+    if jobs <= 1:
+        return schema_class(schema).decode(data)
+    reader = BitReader(data)
+    head, start = BinarySchema(schema[:-1]).read(reader, 0)
+    starts = [position for position in reader.occurrences(_PAGE_HEADER)
+              if position >= start and position % 8 == 0]
+    if (not starts or starts[0] != start or
+            len(starts) != head['page_count']):
+        Logger.warn("Page headers do not match the page count, decoding "
+                    "serially")
+        return schema_class(schema).decode(data)
+    ends = starts[1:] + [len(reader)]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(_decode_page_chunk,
+                           [(_chunk(data, page_start // 8, page_end // 8),
+                             compiled)
+                            for page_start, page_end in zip(starts, ends)])
+    finally:
+        pool.close()
+        pool.join()
+    results, counters = zip(*results)
+    pages = []
+    for page_start, page_end, result in zip(starts, ends, results):
+        if result is None or (page_end != len(reader) and
+                              page_start + result[1] != page_end):
+            Logger.warn("Page at {} did not decode to its header, decoding "
+                        "serially", page_start)
+            return schema_class(schema).decode(data)
+        pages.append(result[0])
+    for hits, misses, interned in counters:
+        ITEM_DECODE_CACHE.hits += hits
+        ITEM_DECODE_CACHE.misses += misses
+        INTERNED_PROPERTIES.update(interned)
+    position = starts[-1] + results[-1][1]
+    values = head.to_dict()
+    values.update(pages=pages, __origin=reader.span(0, position))
+    stash = schema_class(schema).record_class.from_dict(values)
+    stash.track_changes()
+    unparsed = reader.to_bits(position)
+    if unparsed:
+        stash[BinarySchema.UNPARSED_FIELD] = unparsed
+    return stash
+
+
+# Starting a pool takes about as long as encoding this many items serially
+_PARALLEL_ENCODE_MIN_ITEMS = 10000
+
+# Stash being encoded by the pool workers, set by `_init_page_encoder`
+_ENCODING = {}
+
+
+def _init_page_encoder(stash, compiled):
+    _ENCODING['stash'] = stash
+    _ENCODING['schema'] = (CompiledSchema if compiled else
+                           BinarySchema)(_PAGE_SCHEMA)
+
+
+def _encode_page(page_no):
+    stash = _ENCODING['stash']
+    writer = BitWriter()
+    _ENCODING['schema'].write(writer, stash['pages'][page_no], parent=stash)
+    return writer.getvalue(), len(writer)
+
+
+def encode_stash(stash, jobs=1, compiled=False, outputs=None,
+                 min_items=_PARALLEL_ENCODE_MIN_ITEMS):
+    ''' Encodes `stash`, splitting the pages among `jobs` processes. '''
+    schema = (_SHARED_STASH_SCHEMA if stash['header'] == _SHARED_STASH_HEADER
+              else _PERSONAL_STASH_SCHEMA)
+    schema_class = CompiledSchema if compiled else BinarySchema
+    pages = stash['pages']
+    if (jobs <= 1 or len(pages) != stash['page_count'] or
+            sum(len(p['items']) for p in pages) < min_items or
+            isinstance(stash, Record) and is_unchanged(stash)):
+        if outputs is not None:
+            return schema_class(schema).encode_to(stash, outputs)
+        return schema_class(schema).encode(stash)
+    if outputs is not None and not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    writer = BitWriter(outputs)
+    BinarySchema(schema[:-1]).write(writer, as_dict(stash))
+    pool = multiprocessing.Pool(jobs, _init_page_encoder, (stash, compiled))
+    try:
+        for contents, size in pool.imap(_encode_page, xrange(len(pages))):
+            writer.write_bytes(contents, size)
+    finally:
+        pool.close()
+        pool.join()
+    writer.write_bits(stash.get(BinarySchema.UNPARSED_FIELD, ''))
+    if outputs is not None:
+        writer.finish()
+        return len(writer) // 8
+    return writer.getvalue()
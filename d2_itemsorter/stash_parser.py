@@ -8,6 +8,7 @@ import itertools
 import logging
 import os
 import pstats
+import shutil
 import sys
 import time
 
@@ -15,22 +16,20 @@ from pignacio_scripts.terminal import color
 import click
 
 from .items import (MISSING_ITEM_TYPES, UNIQUE_QUALITY_ID, SET_QUALITY_ID,
-                    Item, get_item_type_info, item_has_defense,
-                    item_has_quantity, item_has_durability)
+                    Item, get_item_type_info)
 from .logger import Logger
-from .pager import item_type_filter, ItemFilter, items_to_pages
-from .props import PropertyList, MISSING_PROPERTY_IDS
-from .schema import (SchemaPiece, Integer, Chars, BinarySchema, Until,
-                     NullTerminatedChars)
-from .utils import str_to_bits, bits_to_str, bits_to_int
+from .pager import (item_type_filter, FilterIndex, ItemFilter,
+                    items_to_pages)
+from .props import INTERNED_PROPERTIES, MISSING_PROPERTY_IDS
+from .records import origin_bits
+from .schema import BinarySchema
+from .stash_format import (ITEM_DECODE_CACHE, _ITEM_HEADER, _ITEM_SCHEMA,
+                           _PAGE_HEADER, _map_contents, decode_stash,
+                           encode_stash)
+from .utils import bits_to_str, bits_to_int
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
-_SHARED_STASH_HEADER = str_to_bits("\x53\x53\x53\x00\x30\x31")
-_STASH_HEADER = str_to_bits("\x43\x53\x54\x4d\x30\x31")
-_PAGE_HEADER = str_to_bits("\x53\x54\x00\x4a\x4d")
-_ITEM_HEADER = str_to_bits("\x4a\x4d")
-
 _GREEN_TICK = color.bright_green(u"[✓]")
 _RED_CROSS = color.bright_red(u"[✗]")
 
@@ -48,14 +47,14 @@ def _check_stash(stash):
                        key=lambda i: Item(i).position())):
             item_count += 1
             item = Item(item_data)
-            bits = item_schema.to_bits(item_data)
+            bits = item_schema.to_bits(item_data, reuse=False)
             tail = item_data['item']['tail']
             tail_is_padding = not tail or (len(tail) < 8 and
                                            set(tail) == {'0'})
             _ITEM_PARSES[tail_is_padding] += 1
             if not tail_is_padding:
                 _FAILED_PARSES[item.type()] += 1
-            if bits != item_data['__origin']:
+            if bits != origin_bits(item_data):
                 item_info = item.info()
                 data = "{d.id} = {d.name} ({d.width}x{d.height})".format(
                     d=item_info)
@@ -110,7 +109,8 @@ def _show_missing_parses_in_stash(stash):
                                     specific_info.get('quantity'),
                                     specific_info.get('num_sockets'),
                                    )
-                        Logger.info("SpecInfo Origin: {}", specific_info['__origin'])
+                        Logger.info("SpecInfo Origin: {}",
+                                    origin_bits(specific_info))
                         proplist = specific_info.get('properties')
                         if proplist is not None:
                             with Logger.add_level('Properties:'):
@@ -183,7 +183,8 @@ def _show_stash(stash, show_extended=True):
                                     specific_info.get('quantity'),
                                     specific_info.get('num_sockets'),
                                    )
-                        Logger.info("SpecInfo Origin: {}", specific_info['__origin'])
+                        Logger.info("SpecInfo Origin: {}",
+                                    origin_bits(specific_info))
                         proplist = specific_info.get('properties')
                         if proplist is not None:
                             with Logger.add_level('Properties:'):
@@ -329,14 +330,14 @@ def _get_all_sorted_item_types(sort_order):
 
 def _extract_items(pages, filters):
     extracted = collections.defaultdict(list)
+    index = FilterIndex(filters)
     for page in pages:
         new_page_items = []
         for item_data in page['items']:
             item = Item(item_data)
-            for item_filter in filters:
-                if item_filter.filter(item):
-                    extracted[item_filter.name].append(item)
-                    break
+            item_filter = index.match(item)
+            if item_filter is not None:
+                extracted[item_filter.name].append(item)
             else:
                 new_page_items.append(item_data)
         page['items'] = new_page_items
@@ -368,10 +369,10 @@ def _sort_items(items_by_filter, sort_order):
     return sorted_items
 
 
-def _process_handle(handle, patch=False):
+def _process_handle(handle, patch=False, compiled=False, jobs=1):
     with Logger.add_level("Reading from '{}'", handle.name):
-        str_contents = handle.read()
-        Logger.info("Size: {} bytes", len(str_contents))
+        contents = _map_contents(handle)
+        Logger.info("Size: {} bytes", len(contents))
         if os.path.exists(handle.name):
             fname, extension = os.path.basename(handle.name).rsplit(".", 1)
             backup_file = os.path.join("backups", "{}-{}.{}".format(
@@ -381,18 +382,11 @@ def _process_handle(handle, patch=False):
             except OSError:
                 pass
             Logger.info("Writing backup...")
-            with open(backup_file, 'wb') as fout:
-                fout.write(str_contents)
+            shutil.copyfile(handle.name, backup_file)
             Logger.info("Done writing backup")
 
-        Logger.info('Converting to binary string')
-        binary_str = str_to_bits(str_contents)
-
         Logger.info('Decoding...')
-        parser = (BinarySchema(_SHARED_STASH_SCHEMA)
-                  if binary_str.startswith(_SHARED_STASH_HEADER) else
-                  BinarySchema(_PERSONAL_STASH_SCHEMA))
-        stash = parser.decode(binary_str)
+        stash = decode_stash(contents, jobs=jobs, compiled=compiled)
         Logger.info('Decoded')
 
         if not _check_stash(stash):
@@ -436,198 +430,24 @@ def _process_handle(handle, patch=False):
 
         # _show_stash(stash)
 
-        Logger.info("Encoding...")
-        binary = parser.encode(stash)
-        contents = bits_to_str(binary)
-        Logger.info("Encoded. Size: {} ({} bits)", len(contents), len(binary))
-
-        if os.path.exists(handle.name) and patch:
+        destinations = ["/tmp/test.d2x"]
+        patched = os.path.exists(handle.name) and patch
+        if patched:
+            # The stash file may be mapped into memory, and the encoder
+            # copies unchanged bits from it, so it is replaced only at the end
             Logger.info('Patching: {}', handle.name)
-            with open(handle.name, 'wb') as fout:
-                fout.write(contents)
-
-        with open("/tmp/test.d2x", "w") as fout:
-            Logger.info('Writing to: /tmp/test.d2x', handle.name)
-            fout.write(contents)
-
-
-_ITEMS_WITHOUT_PROPERTIES = set()
-
-
-def _parent_type(values):
-    return values[BinarySchema.PARENT_FIELD]['item_type']
-
-
-def _parent_quality(values):
-    return values[BinarySchema.PARENT_FIELD]['extended_info']['quality']
-
-
-_SPECIFIC_ITEM_SCHEMA = [
-    SchemaPiece(
-        'defense',
-        Integer(11),
-        condition=lambda v: item_has_defense(_parent_type(v))),
-    SchemaPiece(
-        'max_durability',
-        Integer(9),
-        condition=lambda v: item_has_durability(_parent_type(v))),
-    SchemaPiece(
-        'current_durability',
-        Integer(9),
-        condition='max_durability'),
-    SchemaPiece(
-        'num_sockets',
-        Integer(4),
-        condition='..socketed'),
-    SchemaPiece(
-        'quantity',
-        Integer(9),
-        condition=lambda v: item_has_quantity(_parent_type(v))),
-    SchemaPiece('has_set_props_1', Integer(1),
-                condition=lambda v: _parent_quality(v) == 5),
-    SchemaPiece('has_set_props_2', Integer(1),
-                condition=lambda v: _parent_quality(v) == 5),
-    SchemaPiece('has_set_props_3', Integer(1),
-                condition=lambda v: _parent_quality(v) == 5),
-    SchemaPiece('has_set_props_4', Integer(1),
-                condition=lambda v: _parent_quality(v) == 5),
-    SchemaPiece('has_set_props_5', Integer(1),
-                condition=lambda v: _parent_quality(v) == 5),
-    SchemaPiece('properties', PropertyList(),
-                condition=lambda v: _parent_type(v) not in _ITEMS_WITHOUT_PROPERTIES),
-    SchemaPiece('set_props_1', PropertyList(), condition='has_set_props_1'),
-    SchemaPiece('set_props_2', PropertyList(), condition='has_set_props_2'),
-    SchemaPiece('set_props_3', PropertyList(), condition='has_set_props_3'),
-    SchemaPiece('set_props_4', PropertyList(), condition='has_set_props_4'),
-    SchemaPiece('set_props_5', PropertyList(), condition='has_set_props_5'),
-]  # yapf: disable
-
-_EXTENDED_ITEM_SCHEMA = [
-    SchemaPiece('gem_count', Integer(3)),
-    SchemaPiece('guid', 32),
-    SchemaPiece('drop_level', Integer(7)),
-    SchemaPiece('quality', Integer(4)),
-    SchemaPiece('has_gfx', Integer(1)),
-    SchemaPiece('gfx', Integer(3), condition='has_gfx'),
-    SchemaPiece('has_class_info', Integer(1)),
-    SchemaPiece('class_info', 11, condition='has_class_info'),
-    SchemaPiece('lo_qual_type', Integer(3),
-                condition=lambda v: v['quality'] == 1),
-    SchemaPiece('hi_qual_type', Integer(3),
-                condition=lambda v: v['quality'] == 3),
-    SchemaPiece('magic_prefix', Integer(11),
-                condition=lambda v: v['quality'] == 4),
-    SchemaPiece('magic_suffix', Integer(11),
-                condition=lambda v: v['quality'] == 4),
-    SchemaPiece('set_id', Integer(12),
-                condition=lambda v: v['quality'] == 5),
-    SchemaPiece('rare_name_1', Integer(8),
-                condition=lambda v: v['quality'] in (6, 8,)),
-    SchemaPiece('rare_name_2', Integer(8),
-                condition=lambda v: v['quality'] in (6, 8,)),
-    SchemaPiece('has_prefix_1', Integer(1),
-                condition=lambda v: v['quality'] in (6, 8,)),
-    SchemaPiece('prefix_1', Integer(11),
-                condition='has_prefix_1'),
-    SchemaPiece('has_suffix_1', Integer(1),
-                condition=lambda v: v['quality'] in (6, 8,)),
-    SchemaPiece('suffix_1', Integer(11),
-                condition='has_suffix_1'),
-    SchemaPiece('has_prefix_2', Integer(1),
-                condition=lambda v: v['quality'] in (6, 8,)),
-    SchemaPiece('prefix_2', Integer(11),
-                condition='has_prefix_2'),
-    SchemaPiece('has_suffix_2', Integer(1),
-                condition=lambda v: v['quality'] in (6, 8,)),
-    SchemaPiece('suffix_2', Integer(11),
-                condition='has_suffix_2'),
-    SchemaPiece('has_prefix_3', Integer(1),
-                condition=lambda v: v['quality'] in (6, 8,)),
-    SchemaPiece('prefix_3', Integer(11),
-                condition='has_prefix_3'),
-    SchemaPiece('has_suffix_3', Integer(1),
-                condition=lambda v: v['quality'] in (6, 8,)),
-    SchemaPiece('suffix_3', Integer(11),
-                condition='has_suffix_3'),
-    SchemaPiece('unique_id', Integer(12),
-                condition=lambda v: v['quality'] == 7),
-    SchemaPiece('runeword', Integer(16),
-                condition='..has_runeword'),
-    SchemaPiece('runeword', NullTerminatedChars(7),
-                condition='..inscribed'),
-]  # yapf: disable
-
-
-_ITEM_DATA_SCHEMA = [
-    SchemaPiece('header', Chars(2)),
-    SchemaPiece('_unk1', 4),
-    SchemaPiece('identified', Integer(1)),
-    SchemaPiece('_unk2', 6),
-    SchemaPiece('socketed', Integer(1)),
-    SchemaPiece('_unk3', 9),
-    SchemaPiece('simple', Integer(1)),
-    SchemaPiece('ethereal', Integer(1)),
-    SchemaPiece('_unk4', 1),
-    SchemaPiece('inscribed', Integer(1)),
-    SchemaPiece('_unk5', 1),
-    SchemaPiece('has_runeword', Integer(1)),
-    SchemaPiece('_unk6', 22),
-    SchemaPiece('position_x', Integer(4)),
-    SchemaPiece('position_y', Integer(4)),
-    SchemaPiece('_unk7', 3),
-    SchemaPiece('item_type', Chars(4)),
-    SchemaPiece(
-        'extended_info',
-        BinarySchema(_EXTENDED_ITEM_SCHEMA),
-        condition=lambda v: not v['simple']),
-    SchemaPiece('has_random_pad', Integer(1)),
-    SchemaPiece('random_pad', Integer(96), condition='has_random_pad'),
-    SchemaPiece(
-        'specific_info',
-        BinarySchema(_SPECIFIC_ITEM_SCHEMA),
-        condition=lambda v: not v['simple']),
-    SchemaPiece('tail', Until([_PAGE_HEADER, _ITEM_HEADER]))
-]  # yapf: disable
-
-
-_ITEM_SCHEMA = [
-    SchemaPiece('item', BinarySchema(_ITEM_DATA_SCHEMA)),
-    SchemaPiece(
-        'gems',
-        BinarySchema(_ITEM_DATA_SCHEMA),
-        multiple=lambda v: v['item'].get('extended_info', {}).get('gem_count', 0)),
-]  # yapf: disable
-
-
-_PAGE_SCHEMA = [
-    SchemaPiece('header', Chars(5)),
-    SchemaPiece('item_count', Integer(16)),
-    SchemaPiece(
-        'items',
-        BinarySchema(_ITEM_SCHEMA),
-        multiple=lambda v: v['item_count']),
-]  # yapf: disable
-
-
-_PERSONAL_STASH_SCHEMA = [
-    SchemaPiece('header', Chars(6)),
-    SchemaPiece('_unk1', 32),
-    SchemaPiece('page_count', Integer(32)),
-    SchemaPiece(
-        'pages',
-        BinarySchema(_PAGE_SCHEMA),
-        multiple=lambda v: v['page_count']),
-]  # yapf: disable
-
-
-_SHARED_STASH_SCHEMA = [
-    SchemaPiece('header', Chars(6)),
-    SchemaPiece('page_count', Integer(32)),
-    SchemaPiece(
-        'pages',
-        BinarySchema(_PAGE_SCHEMA),
-        multiple=lambda v: v['page_count']),
-]  # yapf: disable
+            destinations.insert(0, handle.name + '.tmp')
+        Logger.info('Encoding to: {}', ", ".join(destinations))
+        outputs = [open(destination, 'wb') for destination in destinations]
+        try:
+            size = encode_stash(stash, jobs=jobs, compiled=compiled,
+                                outputs=outputs)
+        finally:
+            for output in outputs:
+                output.close()
+        if patched:
+            os.rename(destinations[0], handle.name)
+        Logger.info("Encoded. Size: {} ({} bits)", size, size * 8)
 
 
 @click.command()
@@ -635,7 +455,11 @@ _SHARED_STASH_SCHEMA = [
 @click.option('--debug', is_flag=True, help='Turn on debug mode')
 @click.option('--patch', is_flag=True, help='Patch the file in place')
 @click.option('--profile', is_flag=True, help='Profile the execution')
-def parse(filename, debug, patch, profile):
+@click.option('--compiled', is_flag=True,
+              help='Decode and encode through generated schema functions')
+@click.option('--jobs', type=int, default=1,
+              help='Decode and encode pages in this many processes')
+def parse(filename, debug, patch, profile, compiled, jobs):
     level = logging.DEBUG if debug else logging.INFO
     logging.basicConfig(stream=sys.stdout, level=level)
     logging.debug("PAGE: %s, %s", _PAGE_HEADER, bits_to_str(_PAGE_HEADER))
@@ -647,7 +471,7 @@ def parse(filename, debug, patch, profile):
     else:
         profiler = None
 
-    _process_handle(filename, patch=patch)
+    _process_handle(filename, patch=patch, compiled=compiled, jobs=jobs)
 
     if profiler:
         profiler.disable()
@@ -663,6 +487,14 @@ def parse(filename, debug, patch, profile):
         print repr(sorted(MISSING_PROPERTY_IDS.items()))
         print repr(MISSING_PROPERTY_IDS.most_common())
 
+    print "Item decode cache: {} hits, {} misses ({} cached)".format(
+        ITEM_DECODE_CACHE.hits, ITEM_DECODE_CACHE.misses,
+        len(ITEM_DECODE_CACHE))
+
+    if INTERNED_PROPERTIES:
+        print "Interned properties: {} shared, {} distinct".format(
+            INTERNED_PROPERTIES['hits'], INTERNED_PROPERTIES['misses'])
+
     print "Full parses?: ", _ITEM_PARSES
     import pprint
     print "Failed parses: ", pprint.pprint(_FAILED_PARSES.most_common())
@@ -2,10 +2,14 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division
 
+import binascii
 import logging
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+# Bits of every byte value, LSB first
+BYTE_BITS = [format(b, '08b')[::-1] for b in xrange(256)]
+
 
 def bits_to_int(bits):
     value = 0
@@ -32,6 +36,11 @@ def int_to_bits(value, padding=8):
 
 
 def bytes_to_bits(bytes_):
+    if isinstance(bytes_, (list, tuple, bytearray)):
+        try:
+            return str_to_bits(bytes(bytearray(bytes_)))
+        except (TypeError, ValueError):
+            pass
     for index, byte in enumerate(bytes_):
         if not 0 <= byte < 256:
             raise ValueError("Invalid byte value at index {}: {}".format(index,
@@ -40,16 +49,32 @@ def bytes_to_bits(bytes_):
 
 
 def bits_to_bytes(bits):
+    if isinstance(bits, str):
+        return list(bytearray(bits_to_str(bits)))
     return [bits_to_int(bits[s:s + 8][::-1]) for s in xrange(0, len(bits), 8)]
 
 
 def bits_to_str(bits, char_size=8):
+    if char_size == 8 and isinstance(bits, str) and not bits.translate(
+            None, '01'):
+        return _bits_to_bytes_str(bits)
     split_bits = (bits[s:s + char_size]
                   for s in xrange(0, len(bits), char_size))
     char_ords = (bits_to_int(bs[::-1]) for bs in split_bits)
     return "".join(chr(o) for o in char_ords)
 
 
+def _bits_to_bytes_str(bits):
+    # The whole string is parsed as a single int, most significant bit last
+    if not bits:
+        return ''
+    size = (len(bits) + 7) // 8
+    return binascii.unhexlify('{:0{}x}'.format(int(bits[::-1], 2),
+                                               size * 2))[::-1]
+
+
 def str_to_bits(chars, char_size=8):
+    if char_size == 8 and isinstance(chars, str):
+        return ''.join([BYTE_BITS[b] for b in bytearray(chars)])
     char_ords = (ord(c) for c in chars)
     return "".join(int_to_bits(o, padding=char_size)[::-1] for o in char_ords)
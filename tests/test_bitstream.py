@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=protected-access,invalid-name
+from __future__ import absolute_import, division
+
+import io
+import logging
+import pickle
+
+from pignacio_scripts.testing.testcase import TestCase
+
+from d2_itemsorter.bitstream import BitReader, BitWriter, as_reader
+from d2_itemsorter.utils import str_to_bits
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class _Output(io.BytesIO):
+    def __init__(self):
+        io.BytesIO.__init__(self)
+        self.sizes = []
+
+    def write(self, data):
+        self.sizes.append(len(data))
+        return io.BytesIO.write(self, data)
+
+
+class BitReaderTests(TestCase):
+    ''' Tests for `d2_itemsorter.bitstream.BitReader`.'''
+
+    def test_read_int_bit_order(self):
+        reader = BitReader('\x02\xbf')
+        self.assertEqual(reader.read_int(0, 8), 0x02)
+        self.assertEqual(reader.read_int(8, 8), 0xbf)
+        self.assertEqual(reader.read_int(0, 16), 0xbf02)
+        self.assertEqual(reader.read_int(1, 1), 1)
+        self.assertEqual(reader.read_int(4, 8), 0xf0)
+
+    def test_read_wide_int(self):
+        data = '\x01\x23\x45\x67\x89\xab\xcd\xef\xfe\xdc\xba\x98'
+        reader = BitReader(data)
+        self.assertEqual(reader.read_int(0, 96),
+                         0x98badcfeefcdab8967452301)
+        self.assertEqual(reader.read_int(4, 80), 0xadcfeefcdab896745230)
+
+    def test_read_past_end_is_zero_padded(self):
+        reader = BitReader('\xff')
+        self.assertEqual(reader.read_int(4, 8), 0x0f)
+        self.assertEqual(reader.read_int(8, 8), 0)
+
+    def test_buffer_types(self):
+        for data in [bytearray('\x02\xbf'), memoryview('\x02\xbf')]:
+            reader = BitReader(data)
+            self.assertEqual(reader.read_int(0, 16), 0xbf02)
+            self.assertEqual(reader.to_bits(), '0100000011111101')
+
+    def test_slice_is_a_view(self):
+        reader = BitReader('\x02\xbf')
+        view = reader[3:11]
+        self.assertEqual(len(view), 8)
+        self.assertIs(view.data, reader.data)
+        self.assertEqual(view.to_bits(), '00000111')
+        self.assertEqual(view[2:].to_bits(), '000111')
+
+    def test_to_bits(self):
+        reader = BitReader('azAZ09')
+        self.assertEqual(reader.to_bits(), str_to_bits('azAZ09'))
+        self.assertEqual(reader.to_bits(3, 13), str_to_bits('azAZ09')[3:13])
+        self.assertEqual(reader.to_bits(40, 100), str_to_bits('azAZ09')[40:])
+
+    def test_from_bits(self):
+        reader = BitReader.from_bits('1101')
+        self.assertEqual(len(reader), 4)
+        self.assertEqual(reader.read_int(0, 8), 11)
+        self.assertEqual(reader.to_bits(), '1101')
+
+    def test_as_reader(self):
+        reader = BitReader('a')
+        self.assertIs(as_reader(reader), reader)
+        self.assertEqual(as_reader('101').to_bits(), '101')
+
+    def test_span(self):
+        reader = BitReader('azAZ09')
+        span = reader[3:].span(5, 21)
+
+        self.assertEqual(span.size, 16)
+        self.assertEqual(span.to_bits(), str_to_bits('azAZ09')[8:24])
+        self.assertEqual(span.to_bits(4, 8), str_to_bits('azAZ09')[12:16])
+        self.assertEqual(span, str_to_bits('zA'))
+        self.assertEqual(span, BitReader('zA').span(0, 16))
+        self.assertNotEqual(span, reader.span(0, 16))
+
+    def test_find_aligned(self):
+        reader = BitReader('xxJMyyJM')
+        self.assertEqual(reader.find(str_to_bits('JM')), 16)
+        self.assertEqual(reader.find(str_to_bits('JM'), start=17), 48)
+        self.assertEqual(reader.find(str_to_bits('ZZ')), -1)
+
+    def test_find_unaligned(self):
+        bits = '010' + str_to_bits('xJM') + '11'
+        reader = BitReader.from_bits(bits)
+        self.assertEqual(reader.find(str_to_bits('JM')), bits.index(
+            str_to_bits('JM')))
+        self.assertEqual(reader.find('0110'), bits.index('0110'))
+
+    def test_find_matches_str_index(self):
+        bits = str_to_bits('\x4a\x4d\x25\xa6\x9a\x4a\x4d\x00\x94\x9a')[5:]
+        reader = BitReader.from_bits(bits)
+        for pattern in [str_to_bits('JM'), '1', '0011', '1010010110']:
+            start = 0
+            while True:
+                expected = bits.find(pattern, start)
+                self.assertEqual(reader.find(pattern, start), expected)
+                if expected < 0:
+                    break
+                start = expected + 1
+
+    def test_find_in_view(self):
+        reader = BitReader('JMxxJM')[8:]
+        self.assertEqual(reader.find(str_to_bits('JM')), 24)
+        self.assertEqual(reader[:30].find(str_to_bits('JM')), -1)
+
+    def test_find_past_first_window(self):
+        reader = BitReader('x' * 9000 + 'JM' + 'x' * 9000 + 'JM')
+        self.assertEqual(reader.find(str_to_bits('JM')), 72000)
+        self.assertEqual(reader.find(str_to_bits('JM'), 72001), 144016)
+        self.assertEqual(reader.find(str_to_bits('JM'), 0, 72000), -1)
+        self.assertEqual(reader.find(str_to_bits('ZZ')), -1)
+
+    def test_find_indexed_matches_find(self):
+        bits = str_to_bits('\x4a\x4d\x25\xa6\x9a\x4a\x4d\x00\x94\x9a')[5:]
+        reader = BitReader.from_bits(bits)
+        for pattern in [str_to_bits('JM'), '1', '0011', '1010010110']:
+            for start in xrange(len(bits) + 1):
+                self.assertEqual(reader.find_indexed(pattern, start),
+                                 reader.find(pattern, start))
+
+    def test_find_indexed_in_view(self):
+        reader = BitReader('JMxxJMJM')
+        view = reader[8:]
+        self.assertEqual(view.find_indexed(str_to_bits('JM')), 24)
+        self.assertEqual(view[:30].find_indexed(str_to_bits('JM')), -1)
+        self.assertEqual(view[:40].find_indexed(str_to_bits('JM'), 25), -1)
+
+    def test_find_not_indexed(self):
+        view = BitReader('JMxxJMJM', indexed=False)[8:]
+        self.assertEqual(view.find_indexed(str_to_bits('JM')), 24)
+        self.assertEqual(view[:40].find_indexed(str_to_bits('JM'), 25), -1)
+        self.assertEqual(view._shared.occurrences, {})
+
+    def test_occurrences_are_shared_by_views(self):
+        reader = BitReader('JMxxJM')
+        positions = reader[8:].occurrences(str_to_bits('JM'))
+        self.assertEqual(positions, [0, 32])
+        self.assertIs(reader.occurrences(str_to_bits('JM')), positions)
+
+    def test_pickle(self):
+        reader = BitReader('JMxxJM')[8:]
+        reader.occurrences(str_to_bits('JM'))
+        copy = pickle.loads(pickle.dumps(reader, 2))
+
+        self.assertEqual(copy.to_bits(), reader.to_bits())
+        self.assertEqual(copy.find_indexed(str_to_bits('JM')), 24)
+
+
+class BitWriterTests(TestCase):
+    ''' Tests for `d2_itemsorter.bitstream.BitWriter`.'''
+
+    def test_bit_order(self):
+        writer = BitWriter()
+        writer.write(0x02, 8)
+        writer.write(0xbf, 8)
+        self.assertEqual(writer.getvalue(), '\x02\xbf')
+        self.assertEqual(writer.to_bits(), str_to_bits('\x02\xbf'))
+
+    def test_unaligned_writes(self):
+        writer = BitWriter()
+        writer.write(2, 4)
+        writer.write(0xf0, 8)
+        writer.write(0xb, 4)
+        self.assertEqual(writer.getvalue(), '\x02\xbf')
+
+    def test_partial_byte_is_zero_padded(self):
+        writer = BitWriter()
+        writer.write(5, 3)
+        self.assertEqual(len(writer), 3)
+        self.assertEqual(writer.getvalue(), '\x05')
+        self.assertEqual(writer.to_bits(), '101')
+
+    def test_wide_values(self):
+        writer = BitWriter()
+        writer.write(1, 1)
+        writer.write(0x98badcfeefcdab8967452301, 96)
+        reader = BitReader(writer.getvalue())
+        self.assertEqual(len(writer), 97)
+        self.assertEqual(reader.read_int(1, 96), 0x98badcfeefcdab8967452301)
+
+    def test_write_bits(self):
+        writer = BitWriter()
+        writer.write_bits('1')
+        writer.write_bits('')
+        writer.write_bits(str_to_bits('azAZ09'))
+        self.assertEqual(writer.to_bits(), '1' + str_to_bits('azAZ09'))
+
+    def test_copy(self):
+        reader = BitReader('azAZ09')
+        writer = BitWriter()
+        writer.write(1, 1)
+        writer.copy(reader, 3, 40)
+        BitReader('az').span(0, 16).write(writer, 8)
+
+        self.assertEqual(writer.to_bits(), '1' + str_to_bits('azAZ09')[3:40] +
+                         str_to_bits('z'))
+
+    def test_write_bytes(self):
+        writer = BitWriter()
+        writer.write_bytes('az')
+        writer.write_bytes('AZ', 12)
+        writer.write_bytes('09')
+
+        self.assertEqual(writer.to_bits(), str_to_bits('azAZ')[:28] +
+                         str_to_bits('09'))
+
+    def test_outputs(self):
+        outputs = [io.BytesIO(), io.BytesIO()]
+        writer = BitWriter(outputs, buffer_size=2)
+        writer.write_bytes('azA')
+        self.assertEqual(outputs[0].getvalue(), 'azA')
+        writer.write(5, 3)
+        writer.write_bits(str_to_bits('Z09'))
+        self.assertEqual(len(writer), 51)
+        writer.finish()
+
+        expected = BitWriter()
+        expected.write_bytes('azA')
+        expected.write(5, 3)
+        expected.write_bits(str_to_bits('Z09'))
+        for output in outputs:
+            self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_copy_to_outputs_in_chunks(self):
+        data = ''.join(chr(i) for i in xrange(256)) * 2
+        for prefix in ['', '1', '101']:
+            output = _Output()
+            writer = BitWriter([output], buffer_size=64)
+            writer.write_bits(prefix)
+            writer.copy(BitReader(data)[8:], 0, 4000)
+            writer.finish()
+
+            bits = prefix + str_to_bits(data)[8:4008]
+            self.assertEqual(output.getvalue(), BitReader.from_bits(
+                bits).data)
+            self.assertTrue(all(0 < size <= 128 for size in output.sizes),
+                            output.sizes)
+
+    def test_finish_without_pending_bytes(self):
+        output = _Output()
+        writer = BitWriter([output], buffer_size=2)
+        writer.write_bytes('az')
+        writer.finish()
+
+        self.assertEqual(output.sizes, [2])
+
+    def test_extra_bits_are_dropped(self):
+        writer = BitWriter()
+        writer.write(0xff, 4)
+        writer.write(0, 4)
+        self.assertEqual(writer.getvalue(), '\x0f')
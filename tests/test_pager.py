@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=protected-access,invalid-name
+from __future__ import absolute_import, division
+
+import logging
+
+from pignacio_scripts.testing.testcase import TestCase
+
+from d2_itemsorter.items import Item
+from d2_itemsorter.pager import FilterIndex, ItemFilter, item_type_filter
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def _item(item_type, **kwargs):
+    data = {'item_type': item_type}
+    data.update(kwargs)
+    return Item({'item': data, 'gems': []})
+
+
+class FilterIndexTests(TestCase):
+    ''' Tests for `d2_itemsorter.pager.FilterIndex`.'''
+
+    def setUp(self):
+        super(FilterIndexTests, self).setUp()
+        self.marked = ItemFilter(
+            'marked', filter=lambda i: i.data['item'].get('mark'))
+        self.filters = [
+            item_type_filter('amu '),
+            self.marked,
+            item_type_filter('rin '),
+            ItemFilter('both', filter=None, types={'amu ', 'jew '}),
+        ]
+        self.index = FilterIndex(self.filters)
+
+    def test_match_by_type(self):
+        self.assertIs(self.index.match(_item('amu ')), self.filters[0])
+        self.assertIs(self.index.match(_item('rin ')), self.filters[2])
+        self.assertIs(self.index.match(_item('jew ')), self.filters[3])
+        self.assertIsNone(self.index.match(_item('gld1')))
+
+    def test_predicates_keep_precedence(self):
+        self.assertIs(self.index.match(_item('amu ', mark=True)),
+                      self.filters[0])
+        self.assertIs(self.index.match(_item('rin ', mark=True)), self.marked)
+        self.assertIs(self.index.match(_item('gld1', mark=True)), self.marked)
+
+    def test_matches_linear_scan(self):
+        for item in [_item('amu '), _item('rin ', mark=True), _item('gld1'),
+                     _item('jew ', mark=True), _item('jew ')]:
+            expected = next((f for f in self.filters
+                             if f.types is None and f.filter(item) or
+                             f.types is not None and item.type() in f.types),
+                            None)
+            self.assertIs(self.index.match(item), expected)
@@ -4,10 +4,16 @@
 from __future__ import absolute_import, division
 
 import logging
+import pickle
 
 from pignacio_scripts.testing import TestCase
 
-from d2_itemsorter.props import PropertyList, PropertyDef, Property, PropList
+from d2_itemsorter.bitstream import BitReader
+from d2_itemsorter.props import (_PROPERTIES, INTERNED_PROPERTIES,
+                                 PropertyList, PropertyDef, Property, PropList,
+                                 clear_interned_properties, intern_property,
+                                 property_table)
+from d2_itemsorter.schema import ParseError
 
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -44,7 +50,7 @@ class PropertyListTests(TestCase):
 
         self.assertListEqual(props.properties,
                              [Property(definition=_TEST_PROPERTIES[1],
-                                       values=[134])])
+                                       values=(134,))])
         self.assertTrue(props.terminated)
         self.assertEqual(advanced, 26)
 
@@ -70,7 +76,7 @@ class PropertyListTests(TestCase):
 
         self.assertListEqual(props.properties,
                              [Property(definition=_TEST_PROPERTIES[2],
-                                       values=[-22])])
+                                       values=(-22,))])
         self.assertTrue(props.terminated)
         self.assertEqual(advanced, 25)
 
@@ -97,7 +103,7 @@ class PropertyListTests(TestCase):
 
         self.assertListEqual(props.properties,
                              [Property(definition=_TEST_PROPERTIES[3],
-                                       values=[27, 256])])
+                                       values=(27, 256))])
         self.assertTrue(props.terminated)
         self.assertEqual(advanced, 35)
 
@@ -124,7 +130,7 @@ class PropertyListTests(TestCase):
 
         self.assertListEqual(props.properties,
                              [Property(definition=_TEST_PROPERTIES[4],
-                                       values=[511])])
+                                       values=(511,))])
         self.assertTrue(props.terminated)
         self.assertEqual(advanced, 27)
 
@@ -141,6 +147,68 @@ class PropertyListTests(TestCase):
                           '111111111'  # Terminator
                           ))
 
+    def test_read_from_offset(self):
+        bits = ('01'  # Unrelated bits
+                '110000000'  # Id = 3
+                '11011000'  # Value = 27
+                '000000001'  # Value = 256
+                '111111111'  # Terminator
+                '0110'  # Unrelated bits
+                )
+        props, position = self.prop_list.read(BitReader.from_bits(bits), 2)
+
+        self.assertListEqual(props.properties,
+                             [Property(definition=_TEST_PROPERTIES[3],
+                                       values=(27, 256))])
+        self.assertTrue(props.terminated)
+        self.assertEqual(position, 37)
+
+    def test_skip(self):
+        bits = ('01'  # Unrelated bits
+                '110000000'  # Id = 3
+                '11011000'  # Value = 27
+                '000000001'  # Value = 256
+                '111111111'  # Terminator
+                '0110'  # Unrelated bits
+                )
+        reader = BitReader.from_bits(bits)
+
+        self.assertEqual(self.prop_list.skip(reader, 2),
+                         self.prop_list.read(reader, 2)[1])
+
+    def test_skip_stops_at_unknown_ids(self):
+        reader = BitReader.from_bits('100000000' '00000001' '1111011110')
+
+        self.assertEqual(self.prop_list.skip(reader, 0), 17)
+
+    def test_skip_past_end(self):
+        reader = BitReader.from_bits('110000000' '1101100')
+        self.assertRaises(ParseError, self.prop_list.skip, reader, 0)
+
+    def test_skip_unterminated(self):
+        # Past the end, IDs read as 0, which is a known property
+        reader = BitReader.from_bits('000000000' '0000000001')
+        self.assertRaises(ParseError, PropertyList().skip, reader, 0)
+        self.assertRaises(ParseError, PropertyList().read, reader, 0)
+
+    def test_write_out_of_range(self):
+        props = PropList(properties=[Property(definition=_TEST_PROPERTIES[2],
+                                              values=[100])],
+                         terminated=True)
+
+        self.assertRaises(ValueError, self.prop_list.to_bits, props)
+
+    def test_write_missing_values(self):
+        props = PropList(properties=[Property(definition=_TEST_PROPERTIES[3],
+                                              values=[1])],
+                         terminated=True)
+
+        self.assertRaises(KeyError, self.prop_list.to_bits, props)
+
+    def test_read_past_end(self):
+        self.assertRaises(ParseError, self.prop_list.from_bits,
+                          '110000000' '1101100')
+
     def test_unterminated_from_bits(self):
         bits = '1111011110'
 
@@ -157,3 +225,56 @@ class PropertyListTests(TestCase):
 
         self.assertEqual(bits, '')
 
+
+class PropertyTableTests(TestCase):
+    ''' Tests for `d2_itemsorter.props.property_table`.'''
+
+    def test_layouts(self):
+        table = property_table(_TEST_PROPERTIES)
+
+        self.assertEqual(len(table), 512)
+        self.assertIsNone(table[0])
+        self.assertIs(table[3].definition, _TEST_PROPERTIES[3])
+        self.assertEqual(table[3].size, 17)
+        self.assertEqual(table[3].shifts, [0, 8])
+        self.assertEqual(table[3].masks, [0xff, 0x1ff])
+
+    def test_pack_and_unpack(self):
+        layout = property_table(_TEST_PROPERTIES)[2]
+
+        self.assertEqual(layout.pack([-22]), 10)
+        self.assertEqual(layout.unpack(10), [-22])
+        self.assertIsNone(layout.pack([100]))
+        self.assertIsNone(layout.pack(['a']))
+        self.assertIsNone(layout.pack([]))
+        self.assertIsNone(layout.pack([1, 2]))
+
+
+class InternPropertyTests(TestCase):
+    ''' Tests for `d2_itemsorter.props.intern_property`.'''
+
+    def setUp(self):
+        super(InternPropertyTests, self).setUp()
+        clear_interned_properties()
+
+    def test_identical_properties_are_shared(self):
+        prop = intern_property(_TEST_PROPERTIES[3], [27, 256])
+
+        self.assertEqual(prop.values, (27, 256))
+        self.assertIs(intern_property(_TEST_PROPERTIES[3], (27, 256)), prop)
+        self.assertIsNot(intern_property(_TEST_PROPERTIES[3], [27, 255]), prop)
+        self.assertEqual(INTERNED_PROPERTIES, {'hits': 1, 'misses': 2})
+
+    def test_unpickling_is_not_counted(self):
+        prop = intern_property(_PROPERTIES[0], [10])
+
+        self.assertIs(pickle.loads(pickle.dumps(prop, 2)), prop)
+        self.assertEqual(INTERNED_PROPERTIES, {'misses': 1})
+
+    def test_decoded_properties_are_interned(self):
+        bits = '100000000' '01100001' '100000000' '01100001' '111111111'
+
+        props, _advanced = PropertyList(_TEST_PROPERTIES).from_bits(bits)
+
+        self.assertIs(props.properties[0], props.properties[1])
+        self.assertEqual(INTERNED_PROPERTIES['hits'], 1)
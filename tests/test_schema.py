@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=protected-access,invalid-name
+from __future__ import absolute_import, division
+
+import gc
+import io
+import logging
+import pickle
+import weakref
+
+from pignacio_scripts.testing.testcase import TestCase
+
+from d2_itemsorter.bitstream import BitReader, Span
+from d2_itemsorter.decode_cache import DecodeCache
+from d2_itemsorter.records import Record, origin_bits, record_class
+from d2_itemsorter.schema import (BinarySchema, Chars, FixedRun, Integer,
+                                  ParentCondition, LazyRecord, LazyValue,
+                                  ParseError, SchemaPiece, fixed_offsets,
+                                  group_fixed_runs, resolve_parent_conditions)
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+_RUN_PIECES = [
+    SchemaPiece('header', Chars(2)),
+    SchemaPiece('_unk', 3),
+    SchemaPiece('value', Integer(11)),
+]  # yapf: disable
+
+
+class GroupFixedRunsTests(TestCase):
+    ''' Tests for `d2_itemsorter.schema.group_fixed_runs`.'''
+
+    def test_groups_consecutive_pieces(self):
+        schema = _RUN_PIECES + [
+            SchemaPiece('flagged', Integer(3), condition='value'),
+            SchemaPiece('a', Integer(2)),
+            SchemaPiece('b', Integer(2)),
+        ]
+        plan = group_fixed_runs(schema)
+
+        self.assertEqual([p.field for p in plan],
+                         [('header', '_unk', 'value'), 'flagged', ('a', 'b')])
+        self.assertIsInstance(plan[0].type, FixedRun)
+        self.assertEqual(plan[0].type.size, 30)
+        self.assertEqual(plan[0].type.shifts, [0, 16, 19])
+
+    def test_does_not_group_single_pieces(self):
+        schema = [
+            SchemaPiece('a', Integer(2)),
+            SchemaPiece('b', Integer(2), multiple=2),
+            SchemaPiece('c', Integer(2)),
+        ]
+        self.assertEqual(group_fixed_runs(schema), schema)
+
+
+class FixedRunTests(TestCase):
+    ''' Tests for `d2_itemsorter.schema.FixedRun`.'''
+
+    def setUp(self):
+        super(FixedRunTests, self).setUp()
+        self.run = FixedRun(_RUN_PIECES)
+
+    def test_read(self):
+        reader = BitReader.from_bits(
+            '01' + self.run.to_bits(['JM', '101', 1234]))
+
+        values, position = self.run.read(reader, 2)
+
+        self.assertEqual(values, ['JM', '101', 1234])
+        self.assertEqual(position, 32)
+
+    def test_write_matches_pieces(self):
+        expected = BinarySchema(_RUN_PIECES).to_bits(
+            {'header': 'JM', '_unk': '101', 'value': 1234})
+        self.assertEqual(self.run.to_bits(['JM', '101', 1234]), expected)
+
+    def test_read_near_the_end(self):
+        reader = BitReader.from_bits(
+            self.run.to_bits(['JM', '101', 1234])[:25])
+
+        values, position = self.run.read(reader, 0)
+
+        self.assertEqual(values, ['JM', '101', 1234 & 0x3f])
+        self.assertEqual(position, 30)
+
+    def test_read_past_the_end(self):
+        reader = BitReader('JM')
+        self.assertRaises(ParseError, self.run.read, reader, 0)
+
+    def test_unpackable_values_are_written_one_by_one(self):
+        self.assertEqual(self.run.to_bits(['J', '101', 0]),
+                         BinarySchema(_RUN_PIECES).to_bits(
+                             {'header': 'J', '_unk': '101', 'value': 0}))
+        self.assertRaises(ValueError, self.run.to_bits, ['JM', '101', 2048])
+        self.assertRaises(ValueError, self.run.to_bits, ['JM', '101', -1])
+
+
+_INNER_PIECES = [
+    SchemaPiece('value', Integer(5)),
+    SchemaPiece('extra', Integer(3), condition='..has_extra'),
+]  # yapf: disable
+
+_LAZY_PIECES = [
+    SchemaPiece('has_extra', Integer(1)),
+    SchemaPiece('inner', BinarySchema(_INNER_PIECES), lazy=True),
+    SchemaPiece('chars', Chars(1), lazy=True),
+    SchemaPiece('last', Integer(4)),
+]  # yapf: disable
+
+
+class LazyDecodingTests(TestCase):
+    ''' Tests for `BinarySchema.decode` with `lazy=True`.'''
+
+    def setUp(self):
+        super(LazyDecodingTests, self).setUp()
+        self.schema = BinarySchema(_LAZY_PIECES)
+        self.data = self.schema.encode({
+            'has_extra': 1,
+            'inner': {'value': 17, 'extra': 5},
+            'chars': 'J',
+            'last': 9,
+        })
+
+    def test_lazy_pieces_are_not_decoded(self):
+        res = self.schema.decode(self.data, lazy=True)
+
+        self.assertIsInstance(res['inner'], LazyRecord)
+        self.assertIsInstance(res['chars'], LazyValue)
+        self.assertFalse(res['inner'].decoded)
+        self.assertEqual(res['inner'].span, (1, 9))
+        self.assertEqual(res['last'], 9)
+
+    def test_values_match_eager_decoding(self):
+        eager = self.schema.decode(self.data)
+        res = self.schema.decode(self.data, lazy=True)
+
+        self.assertEqual(res['inner']['extra'], 5)
+        self.assertTrue(res['inner'].decoded)
+        self.assertEqual(dict(res['inner']), dict(eager['inner']))
+        self.assertEqual(res['chars'].value, 'J')
+        self.assertEqual(res['__origin'], eager['__origin'])
+
+    def test_encode_untouched(self):
+        res = self.schema.decode(self.data, lazy=True)
+
+        self.assertEqual(self.schema.encode(res), self.data)
+        self.assertFalse(res['chars'].decoded)
+
+    def test_encode_modified(self):
+        res = self.schema.decode(self.data, lazy=True)
+        res['inner']['value'] = 3
+
+        self.assertEqual(self.schema.decode(self.schema.encode(res))['inner'],
+                         {'value': 3, 'extra': 5,
+                          '__origin': '11000101'})
+
+    def test_encode_to(self):
+        res = self.schema.decode(self.data, lazy=True)
+        res['last'] = 3
+        outputs = [io.BytesIO(), io.BytesIO()]
+
+        size = self.schema.encode_to(res, outputs)
+
+        self.assertEqual(size, len(self.schema.encode(res)))
+        for output in outputs:
+            self.assertEqual(output.getvalue(), self.schema.encode(res))
+
+
+_OUTER_PIECES = [
+    SchemaPiece('has_extra', Integer(1)),
+    SchemaPiece('inner', BinarySchema(_INNER_PIECES), multiple=2),
+    SchemaPiece('raw', 6),
+    SchemaPiece('last', Integer(4),
+                condition=lambda v: v['inner'][1]['value']),
+]  # yapf: disable
+
+
+class FieldProjectionTests(TestCase):
+    ''' Tests for `BinarySchema.decode` with `fields`.'''
+
+    def setUp(self):
+        super(FieldProjectionTests, self).setUp()
+        self.schema = BinarySchema(_OUTER_PIECES)
+        self.data = self.schema.encode({
+            'has_extra': 1,
+            'inner': [{'value': 17, 'extra': 5}, {'value': 2, 'extra': 0}],
+            'raw': '110011',
+            'last': 9,
+        })
+
+    def test_only_requested_fields(self):
+        res = self.schema.decode(self.data, fields=['inner.extra', 'last'])
+
+        self.assertEqual(res, {'inner': [{'extra': 5}, {'extra': 0}],
+                               'last': 9})
+
+    def test_whole_values(self):
+        res = self.schema.decode(self.data, fields=['raw', 'inner',
+                                                    'inner.value'])
+
+        self.assertEqual(res['raw'], '110011')
+        self.assertEqual(res['inner'],
+                         self.schema.decode(self.data)['inner'])
+
+    def test_unknown_fields(self):
+        self.assertRaises(ValueError, self.schema.decode, self.data,
+                          fields=['missing'])
+        self.assertRaises(ValueError, self.schema.decode, self.data,
+                          fields=['last.value'])
+
+
+class RecordTests(TestCase):
+    ''' Tests for `d2_itemsorter.records.Record` and origin reuse.'''
+
+    def setUp(self):
+        super(RecordTests, self).setUp()
+        self.schema = BinarySchema(_OUTER_PIECES)
+        self.data = self.schema.encode({
+            'has_extra': 1,
+            'inner': [{'value': 17, 'extra': 5}, {'value': 2, 'extra': 0}],
+            'raw': '110011',
+            'last': 9,
+        })
+        self.res = self.schema.decode(self.data)
+
+    def test_origin_is_a_span(self):
+        origin = self.res['inner'][1]['__origin']
+
+        self.assertIsInstance(origin, Span)
+        self.assertEqual((origin.start, origin.end), (9, 17))
+        self.assertEqual(origin_bits(self.res['inner'][1]), '01000000')
+        self.assertIsNone(origin_bits({}))
+
+    def test_tracks_changes(self):
+        self.assertIsInstance(self.res, Record)
+        self.assertEqual(self.res.changed, set())
+
+        self.res['has_extra'] = self.res['has_extra']
+        self.res['__origin'] = ''
+        self.assertEqual(self.res.changed, set())
+
+        self.res['raw'] = '000000'
+        del self.res['last']
+        self.assertEqual(self.res.changed, {'raw', 'last'})
+
+    def test_unchanged_records_copy_their_origin(self):
+        self.res['inner'][0]['__origin'] = '1' * 9
+
+        inner = BinarySchema(_INNER_PIECES)
+        parent = {'has_extra': 1}
+
+        self.assertEqual(inner.to_bits(self.res['inner'][0], parent=parent),
+                         '1' * 9)
+        self.assertEqual(inner.to_bits(self.res['inner'][0], parent=parent,
+                                       reuse=False), '10001101')
+        self.assertEqual(self.schema.to_bits(self.res), self.res['__origin'])
+        self.res['raw'] = '000000'
+        self.assertEqual(self.schema.to_bits(self.res)[1:10], '1' * 9)
+
+    def test_changed_records_are_encoded(self):
+        self.res['has_extra'] = 0
+
+        self.assertEqual(self.schema.encode(self.res),
+                         self.schema.encode(self.res, reuse=False))
+        self.assertNotIn('extra',
+                         self.schema.decode(self.schema.encode(self.res))[
+                             'inner'][0])
+
+    def test_changed_nested_records(self):
+        self.res['inner'][1]['value'] = 0
+
+        res = self.schema.decode(self.schema.encode(self.res))
+
+        self.assertEqual(res['inner'][1]['value'], 0)
+        self.assertNotIn('last', res)
+
+    def test_lists_changed_in_place(self):
+        inner = self.res['inner']
+        inner.reverse()
+
+        self.assertEqual(self.res.changed, {'inner'})
+        self.assertEqual(self.schema.encode(self.res),
+                         self.schema.encode(self.res, reuse=False))
+        self.assertEqual(
+            [i['value'] for i in self.schema.decode(
+                self.schema.encode(self.res))['inner']], [2, 17])
+
+    def test_items_replaced_by_dicts(self):
+        self.res['inner'][1] = {'value': 5, 'extra': 1}
+
+        res = self.schema.decode(self.schema.encode(self.res))
+
+        self.assertEqual(res['inner'][1]['value'], 5)
+        self.assertEqual(self.schema.encode(self.res),
+                         self.schema.encode(self.res, reuse=False))
+
+    def test_changed_fixed_fields_are_patched(self):
+        schema = BinarySchema(_RUN_PIECES)
+        res = schema.decode(schema.encode(
+            {'header': 'JM', '_unk': '101', 'value': 1234}))
+        bits = origin_bits(res)
+        res['__origin'] = bits[:16] + '010' + bits[19:]
+        res['value'] = 7
+
+        self.assertEqual(schema.to_bits(res),
+                         bits[:16] + '010' + '11100000000')
+
+    def test_records_use_slots(self):
+        inner = self.res['inner'][0]
+
+        self.assertIs(type(inner), record_class(['value', 'extra']))
+        self.assertFalse(hasattr(inner, '__dict__'))
+        self.assertEqual(sorted(inner), ['__origin', 'extra', 'value'])
+        self.assertEqual(inner, {'value': 17, 'extra': 5,
+                                 '__origin': inner['__origin']})
+
+    def test_extra_keys(self):
+        self.res['other'] = 3
+
+        self.assertEqual(self.res['other'], 3)
+        self.assertIn('other', self.res)
+        self.assertEqual(self.res.changed, {'other'})
+        self.assertEqual(self.res.pop('other'), 3)
+        self.assertRaises(KeyError, lambda: self.res['other'])
+
+    def test_pickle(self):
+        self.res['raw'] = '000000'
+        self.res['inner'][0]['value'] = 3
+        res = pickle.loads(pickle.dumps(self.res, 2))
+        res['inner'].append(res['inner'][0])
+
+        self.assertEqual(res.to_dict().keys(), self.res.to_dict().keys())
+        self.assertEqual(res['inner'][0]['value'], 3)
+        self.assertEqual(res['inner'][0].changed, {'value'})
+        self.assertEqual(res.changed, {'raw', 'inner'})
+
+
+_CACHED_PIECES = [
+    SchemaPiece('kind', Integer(4)),
+    SchemaPiece('position', Integer(4)),
+    SchemaPiece('value', Integer(8)),
+]  # yapf: disable
+
+
+def _cache_key(reader, offset):
+    if reader.read_int(offset, 4) == 0:
+        return None
+    return (reader.read_int(offset, 4), reader.read_int(offset + 8, 8)), \
+        offset + 16
+
+
+class DecodeCacheTests(TestCase):
+    ''' Tests for `d2_itemsorter.decode_cache.DecodeCache`.'''
+
+    def setUp(self):
+        super(DecodeCacheTests, self).setUp()
+        self.cache = DecodeCache(
+            _cache_key,
+            refresh={'position': fixed_offsets(_CACHED_PIECES)['position']})
+        self.schema = BinarySchema([
+            SchemaPiece('records', BinarySchema(_CACHED_PIECES,
+                                                cache=self.cache),
+                        multiple=4),
+        ])
+        self.data = self.schema.encode({'records': [
+            {'kind': 1, 'position': 2, 'value': 3},
+            {'kind': 1, 'position': 5, 'value': 3},
+            {'kind': 0, 'position': 5, 'value': 3},
+            {'kind': 1, 'position': 7, 'value': 4},
+        ]})
+
+    def test_hits_refresh_positions(self):
+        records = self.schema.decode(self.data)['records']
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual([r['position'] for r in records], [2, 5, 5, 7])
+        self.assertEqual(records[1], {'kind': 1, 'position': 5, 'value': 3,
+                                      '__origin': records[1]['__origin']})
+        self.assertEqual(records[1]['__origin'].start, 16)
+        self.assertEqual(records[1].changed, set())
+        self.assertEqual(self.schema.encode(self.schema.decode(self.data)),
+                         self.data)
+
+    def test_cached_values_are_copied(self):
+        self.schema.decode(self.data)['records'][0]['value'] = 9
+
+        records = self.schema.decode(self.data)['records']
+
+        self.assertEqual(records[0]['value'], 3)
+        self.assertEqual(records[1]['value'], 3)
+
+    def test_data_is_not_kept(self):
+        reader = BitReader(self.data)
+        self.schema.decode(reader)
+        reader = weakref.ref(reader)
+        gc.collect()
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(reader())
+
+    def test_least_recently_used_are_dropped(self):
+        self.cache.max_size = 1
+
+        self.schema.decode(self.data)
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual(len(self.cache), 1)
+        self.schema.decode(self.data)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 4))
+
+    def test_lazy_decoding_skips_the_cache(self):
+        self.schema.decode(self.data, lazy=True)
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 0))
+
+
+_LAYOUT_PIECES = [
+    SchemaPiece('a', Integer(2), condition=ParentCondition(
+        lambda p: p['kind'] == 1)),
+    SchemaPiece('b', Integer(3), condition='..flag'),
+    SchemaPiece('c', Integer(4)),
+    SchemaPiece('d', Integer(5), condition='c'),
+]  # yapf: disable
+
+
+class LayoutTests(TestCase):
+    ''' Tests for `BinarySchema` layouts and parent conditions.'''
+
+    def setUp(self):
+        super(LayoutTests, self).setUp()
+        self.schema = BinarySchema(
+            _LAYOUT_PIECES, layout=lambda p: (p['kind'], p['flag']))
+
+    def test_resolve_parent_conditions(self):
+        pieces = resolve_parent_conditions(_LAYOUT_PIECES,
+                                           {'kind': 1, 'flag': 0})
+
+        self.assertEqual([p.field for p in pieces], ['a', 'c', 'd'])
+        self.assertEqual([p.condition for p in pieces[:2]], [None, None])
+        self.assertEqual(pieces[2].condition, 'c')
+
+    def test_layouts_are_shared(self):
+        first = self.schema.layout_schema({'kind': 1, 'flag': 1})
+
+        self.assertIs(self.schema.layout_schema({'kind': 1, 'flag': 1}),
+                      first)
+        self.assertIs(self.schema.layout_schema({'kind': 2, 'flag': 0}),
+                      self.schema.layout_schema({'kind': 3, 'flag': 0}))
+        self.assertIs(BinarySchema(_LAYOUT_PIECES).layout_schema(None),
+                      _LAYOUT_PIECES)
+
+    def test_read_and_write(self):
+        plain = BinarySchema(_LAYOUT_PIECES)
+        for parent in [{'kind': 1, 'flag': 1}, {'kind': 2, 'flag': 0}]:
+            values = {'a': 1, 'b': 5, 'c': 0, 'd': 3}
+            bits = plain.to_bits(values, parent=parent)
+
+            res, size = self.schema.from_bits(bits, parent=parent)
+
+            self.assertEqual(size, len(bits))
+            self.assertEqual(res, plain.from_bits(bits, parent=parent)[0])
+            self.assertEqual(self.schema.to_bits(res, parent=parent,
+                                                 reuse=False), bits)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=protected-access,invalid-name
+from __future__ import absolute_import, division
+
+import logging
+
+from pignacio_scripts.testing.testcase import TestCase
+
+from d2_itemsorter.bitstream import BitReader
+from d2_itemsorter.decode_cache import DecodeCache
+from d2_itemsorter.props import PropertyList, PropList
+from d2_itemsorter.schema import (BinarySchema, Chars, Integer,
+                                  ParentCondition, ParseError, SchemaPiece,
+                                  Until)
+from d2_itemsorter.schema_compiler import CompiledSchema, compile_schema
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+_CHILD_SCHEMA = [
+    SchemaPiece('value', Integer(5)),
+    SchemaPiece('from_parent', Integer(3), condition='..flag'),
+]  # yapf: disable
+
+_TEST_SCHEMA = [
+    SchemaPiece('header', Chars(2)),
+    SchemaPiece('_unk', 3),
+    SchemaPiece('flag', Integer(1)),
+    SchemaPiece('flagged', Integer(4), condition='flag'),
+    SchemaPiece('big', Integer(12), condition=lambda v: v['flag']),
+    SchemaPiece('count', Integer(2)),
+    SchemaPiece('children', BinarySchema(_CHILD_SCHEMA),
+                multiple=lambda v: v['count']),
+    SchemaPiece('pair', Integer(2), multiple=2),
+    SchemaPiece('props', PropertyList()),
+    SchemaPiece('tail', Until(['1111'])),
+]  # yapf: disable
+
+
+def _values(flag):
+    values = {
+        'header': 'JM',
+        '_unk': '101',
+        'flag': flag,
+        'count': 2,
+        'children': [{'value': 17}, {'value': 3}],
+        'pair': [1, 2],
+        'props': PropList(properties=[], terminated=True),
+        'tail': '0',
+    }
+    if flag:
+        values.update(flagged=9, big=1234)
+        for child in values['children']:
+            child['from_parent'] = 5
+    return values
+
+
+class CompiledSchemaTests(TestCase):
+    def test_encode_matches_binary_schema(self):
+        for flag in (0, 1):
+            values = _values(flag)
+            self.assertEqual(
+                CompiledSchema(_TEST_SCHEMA).encode(values),
+                BinarySchema(_TEST_SCHEMA).encode(values))
+
+    def test_decode_matches_binary_schema(self):
+        for flag in (0, 1):
+            data = BinarySchema(_TEST_SCHEMA).encode(_values(flag)) + '\xff'
+            self.assertEqual(
+                CompiledSchema(_TEST_SCHEMA).decode(data),
+                BinarySchema(_TEST_SCHEMA).decode(data))
+
+    def test_decode_values(self):
+        data = BinarySchema(_TEST_SCHEMA).encode(_values(1)) + '\xff'
+        decoded = CompiledSchema(_TEST_SCHEMA).decode(data)
+
+        self.assertEqual(decoded['flagged'], 9)
+        self.assertEqual(decoded['big'], 1234)
+        self.assertEqual([c['from_parent'] for c in decoded['children']],
+                         [5, 5])
+        self.assertEqual(decoded['pair'], [1, 2])
+
+    def test_read_from_offset(self):
+        data = BinarySchema(_TEST_SCHEMA).encode(_values(0))
+        reader = BitReader('\x00' + data)
+        expected, size = BinarySchema(_TEST_SCHEMA).from_bits(
+            BitReader(data))
+
+        decoded, position = CompiledSchema(_TEST_SCHEMA).read(reader, 8)
+
+        self.assertEqual(decoded, expected)
+        self.assertEqual(position, size + 8)
+
+    def test_invalid_integer(self):
+        values = _values(0)
+        values['count'] = 4
+        self.assertRaises(ValueError, CompiledSchema(_TEST_SCHEMA).encode,
+                          values)
+        values['count'] = -1
+        self.assertRaises(ValueError, CompiledSchema(_TEST_SCHEMA).encode,
+                          values)
+
+    def test_end_of_data(self):
+        schema = [SchemaPiece('values', Integer(8), multiple=3)]
+        self.assertRaises(ParseError, CompiledSchema(schema).decode, '\x01')
+
+    def test_decode_cache(self):
+        cache = DecodeCache(lambda reader, offset: (
+            reader.read_int(offset, 8), offset + 8))
+        schema = CompiledSchema([
+            SchemaPiece('children', BinarySchema([
+                SchemaPiece('value', Integer(8))
+            ], cache=cache), multiple=3),
+        ])
+
+        res = schema.decode('\x01\x02\x01')
+
+        self.assertEqual([c['value'] for c in res['children']], [1, 2, 1])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_layout(self):
+        child = BinarySchema([
+            SchemaPiece('big', Integer(8),
+                        condition=ParentCondition(lambda p: p['flag'])),
+            SchemaPiece('small', Integer(4), condition='..flag'),
+        ], layout=lambda p: p['flag'])
+        schema = [
+            SchemaPiece('flag', Integer(1)),
+            SchemaPiece('child', child),
+        ]
+        for data in ['\x03\x02', '\x02\x03']:
+            self.assertEqual(CompiledSchema(schema).decode(data),
+                             BinarySchema(schema).decode(data))
+
+    def test_write_with_layout(self):
+        schema = CompiledSchema([
+            SchemaPiece('a', Integer(2), condition='..flag'),
+            SchemaPiece('c', Integer(4)),
+        ], layout=lambda p: p['flag'])
+
+        self.assertEqual(schema.to_bits({'a': 1, 'c': 3}, parent={'flag': 1}),
+                         '10' '1100')
+        self.assertEqual(schema.to_bits({'c': 3}, parent={'flag': 0}), '1100')
+        # An unchanged record is not copied if its parent changes its layout
+        decoded = schema.read(BitReader('\x0d'), 0, parent={'flag': 1})[0]
+        self.assertEqual(schema.to_bits(decoded, parent={'flag': 1}),
+                         '10' '1100')
+        self.assertEqual(schema.to_bits(decoded, parent={'flag': 0}), '1100')
+
+    def test_cached_per_schema(self):
+        self.assertIs(compile_schema(_TEST_SCHEMA),
+                      compile_schema(_TEST_SCHEMA))
+        self.assertIsNot(compile_schema(_TEST_SCHEMA),
+                         compile_schema(list(_TEST_SCHEMA)))
+
+    def test_debug_tracing_is_opt_in(self):
+        self.assertNotIn('logger.debug', compile_schema(_TEST_SCHEMA).source)
+        self.assertIn('logger.debug',
+                      compile_schema(_TEST_SCHEMA, debug=True).source)
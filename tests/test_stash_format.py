@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# pylint: disable=protected-access,invalid-name
+from __future__ import absolute_import, division
+
+import io
+import logging
+import mmap
+import tempfile
+
+from pignacio_scripts.testing.testcase import TestCase
+
+from d2_itemsorter.schema import BinarySchema
+from d2_itemsorter.stash_format import (_ITEM_DATA_SCHEMA, _ITEM_SCHEMA,
+                                        _PAGE_HEADER, _SHARED_STASH_HEADER,
+                                        _SHARED_STASH_SCHEMA,
+                                        ITEM_DECODE_CACHE, decode_item,
+                                        decode_page, decode_stash,
+                                        encode_stash, index_stash, iterdecode)
+from d2_itemsorter.utils import bits_to_str
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def _simple_item(**kwargs):
+    values = {
+        'header': 'JM',
+        '_unk1': '0000',
+        'identified': 1,
+        '_unk2': '000000',
+        'socketed': 0,
+        '_unk3': '000000000',
+        'simple': 1,
+        'ethereal': 0,
+        '_unk4': '0',
+        'inscribed': 0,
+        '_unk5': '0',
+        'has_runeword': 0,
+        '_unk6': '0' * 22,
+        'position_x': 3,
+        'position_y': 1,
+        '_unk7': '000',
+        'item_type': 'r01 ',
+        'has_random_pad': 0,
+        'tail': '000',
+    }
+    values.update(kwargs)
+    return values
+
+
+def _page(*item_types):
+    return {
+        'header': bits_to_str(_PAGE_HEADER),
+        'item_count': len(item_types),
+        'items': [{'item': _simple_item(item_type=t), 'gems': []}
+                  for t in item_types],
+    }
+
+
+def _stash_data():
+    return BinarySchema(_SHARED_STASH_SCHEMA).encode({
+        'header': _SHARED_STASH_HEADER,
+        'page_count': 3,
+        'pages': [_page('r01 ', 'r02 '), _page(), _page('r03 ')],
+    })
+
+
+class StashIndexTests(TestCase):
+    ''' Tests for `d2_itemsorter.stash_format.index_stash`.'''
+
+    def setUp(self):
+        super(StashIndexTests, self).setUp()
+        self.schema = BinarySchema(_SHARED_STASH_SCHEMA)
+        self.data = _stash_data()
+        self.stash = self.schema.decode(self.data)
+
+    def test_offsets(self):
+        index = index_stash(self.data)
+
+        self.assertEqual([(p.offset, p.end, p.items) for p in index], [
+            (80, 360, [136, 248]),
+            (360, 416, []),
+            (416, 584, [472]),
+        ])
+
+    def test_first_pages(self):
+        self.assertEqual(index_stash(self.data, pages=2),
+                         index_stash(self.data)[:2])
+
+    def test_decode_page(self):
+        for page_no, page in enumerate(self.stash['pages']):
+            self.assertEqual(decode_page(self.data, page_no), page)
+
+    def test_decode_item(self):
+        index = index_stash(self.data)
+
+        self.assertEqual(decode_item(self.data, 0, 1, index=index),
+                         self.stash['pages'][0]['items'][1])
+        self.assertEqual(decode_item(self.data, 2, 0)['item']['item_type'],
+                         'r03 ')
+
+
+class IterdecodeTests(TestCase):
+    ''' Tests for `d2_itemsorter.stash_format.iterdecode`.'''
+
+    def setUp(self):
+        super(IterdecodeTests, self).setUp()
+        schema = BinarySchema(_SHARED_STASH_SCHEMA)
+        self.data = _stash_data()
+        self.expected = [
+            (page_no, item_no, item)
+            for page_no, page in enumerate(schema.decode(self.data)['pages'])
+            for item_no, item in enumerate(page['items'])
+        ]
+
+    def test_contents(self):
+        self.assertEqual(list(iterdecode(self.data)), self.expected)
+        self.assertEqual(list(iterdecode(self.data, compiled=True)),
+                         self.expected)
+
+    def test_file(self):
+        schema = BinarySchema(_ITEM_SCHEMA)
+        with tempfile.TemporaryFile() as fobj:
+            fobj.write(self.data)
+            fobj.flush()
+            encoded = [(page_no, item_no, schema.encode(item))
+                       for page_no, item_no, item in iterdecode(fobj)]
+
+        expected = [(page_no, item_no, schema.encode(item))
+                    for page_no, item_no, item in self.expected]
+        self.assertEqual(encoded, expected)
+
+    def test_file_is_closed(self):
+        with tempfile.TemporaryFile() as fobj:
+            fobj.write(self.data)
+            fobj.flush()
+            items = list(iterdecode(fobj))
+
+        self.assertRaises(ValueError, BinarySchema(_ITEM_SCHEMA).encode,
+                          items[0][2])
+
+
+class OriginReuseTests(TestCase):
+    ''' Tests for encoding stashes whose item lists changed in place.'''
+
+    def setUp(self):
+        super(OriginReuseTests, self).setUp()
+        self.schema = BinarySchema(_SHARED_STASH_SCHEMA)
+        self.stash = self.schema.decode(self.schema.encode({
+            'header': _SHARED_STASH_HEADER,
+            'page_count': 2,
+            'pages': [_page('r01 ', 'r02 '), _page('r03 ')],
+        }))
+
+    def _assert_encodes(self, types):
+        data = self.schema.encode(self.stash)
+
+        self.assertEqual(data, self.schema.encode(self.stash, reuse=False))
+        self.assertEqual([[i['item']['item_type'] for i in p['items']]
+                          for p in self.schema.decode(data)['pages']], types)
+
+    def test_append(self):
+        page = self.stash['pages'][1]
+        page['items'].append(self.stash['pages'][0]['items'][0])
+        page['item_count'] += 1
+
+        self._assert_encodes([['r01 ', 'r02 '], ['r03 ', 'r01 ']])
+
+    def test_pop(self):
+        page = self.stash['pages'][0]
+        page['items'].pop()
+        page['item_count'] -= 1
+
+        self._assert_encodes([['r01 '], ['r03 ']])
+
+    def test_replace(self):
+        items = self.stash['pages'][0]['items']
+        items[0] = {'item': _simple_item(item_type='r09 '), 'gems': []}
+
+        self._assert_encodes([['r09 ', 'r02 '], ['r03 ']])
+
+
+class DecodeStashTests(TestCase):
+    ''' Tests for `d2_itemsorter.stash_format.decode_stash`.'''
+
+    def setUp(self):
+        super(DecodeStashTests, self).setUp()
+        self.schema = BinarySchema(_SHARED_STASH_SCHEMA)
+        self.data = _stash_data()
+
+    def test_jobs_match_serial(self):
+        stash = decode_stash(self.data, jobs=2)
+
+        self.assertEqual(stash, decode_stash(self.data))
+        self.assertEqual(stash.changed, set())
+        self.assertEqual(self.schema.encode(stash), self.data)
+
+    def test_jobs_count_cache_hits(self):
+        ITEM_DECODE_CACHE.clear()
+        decode_stash(self.data)
+        expected = (ITEM_DECODE_CACHE.hits, ITEM_DECODE_CACHE.misses)
+        ITEM_DECODE_CACHE.clear()
+        decode_stash(self.data, jobs=2)
+
+        self.assertEqual((ITEM_DECODE_CACHE.hits, ITEM_DECODE_CACHE.misses),
+                         expected)
+        self.assertEqual(expected, (0, 3))
+
+    def test_buffer_input(self):
+        expected = decode_stash(self.data)
+        with tempfile.TemporaryFile() as fobj:
+            fobj.write(self.data)
+            fobj.flush()
+            mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            for data in [memoryview(self.data), bytearray(self.data), mapped]:
+                for jobs in [1, 2]:
+                    self.assertEqual(decode_stash(data, jobs=jobs), expected)
+            mapped.close()
+
+    def test_page_count_mismatch(self):
+        data = bytearray(self.data)
+        data[6] = 2  # The third page is left unparsed
+        data = bytes(data)
+
+        self.assertEqual(decode_stash(data, jobs=2),
+                         self.schema.decode(data))
+
+
+class EncodeStashTests(TestCase):
+    ''' Tests for `d2_itemsorter.stash_format.encode_stash`.'''
+
+    def setUp(self):
+        super(EncodeStashTests, self).setUp()
+        self.schema = BinarySchema(_SHARED_STASH_SCHEMA)
+        self.stash = self.schema.decode(_stash_data())
+
+    def test_jobs_match_serial(self):
+        pages = self.stash['pages']
+        pages[0]['items'][0]['item']['position_x'] = 5
+        self.stash['pages'] = pages[:1] + [_page('r04 ', 'r05 ')] + pages[1:]
+        self.stash['page_count'] = 4
+
+        self.assertEqual(encode_stash(self.stash, jobs=2, min_items=0),
+                         self.schema.encode(self.stash))
+
+    def test_outputs(self):
+        self.stash['page_count'] = 2
+        self.stash['pages'] = self.stash['pages'][1:]
+        for jobs in [1, 2]:
+            output = io.BytesIO()
+            size = encode_stash(self.stash, jobs=jobs, outputs=output,
+                                min_items=0)
+
+            self.assertEqual(output.getvalue(), self.schema.encode(self.stash))
+            self.assertEqual(size, len(output.getvalue()))
+
+    def test_unparsed_bits(self):
+        self.stash['page_count'] = 2
+        self.stash['pages'] = self.stash['pages'][:2]
+        self.stash[BinarySchema.UNPARSED_FIELD] = '101'
+
+        self.assertEqual(encode_stash(self.stash, jobs=2, min_items=0),
+                         self.schema.encode(self.stash))
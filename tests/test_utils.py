@@ -80,6 +80,13 @@ class BitsToBytesTests(TestCase):
     def test_multiple_bytes(self):
         self.assertEqual(bits_to_bytes('100000000100000000100000'), [1, 2, 4])
 
+    def test_partial_byte(self):
+        self.assertEqual(bits_to_bytes('1000000011'), [1, 3])
+        self.assertEqual(bits_to_bytes(u'1000000011'), [1, 3])
+
+    def test_raises_if_not_binary(self):
+        self.assertRaises(ValueError, bits_to_bytes, '1000x000')
+
 
 class BytesToBitsTests(TestCase):
     ''' Tests for `d2_itemsorter.utils.bytes_to_bits`.'''
@@ -93,6 +100,11 @@ class BytesToBitsTests(TestCase):
 
     def test_negative(self):
         self.assertRaises(ValueError, bytes_to_bits, [-1])
+        self.assertRaises(ValueError, bytes_to_bits, [1, 256])
+
+    def test_bytearray(self):
+        self.assertEqual(bytes_to_bits(bytearray([19, 255])),
+                         '1100100011111111')
 
 
 class BitsToStrTests(TestCase):
@@ -106,6 +118,20 @@ class BitsToStrTests(TestCase):
             bits_to_str("100001100101111010000010010110100000110010011100"),
             'azAZ09')
 
+    def test_partial_char(self):
+        self.assertEqual(bits_to_str("0100000011"), '\x02\x03')
+        self.assertEqual(bits_to_str(""), '')
+
+    def test_all_bytes(self):
+        bits = ''.join(format(b, '08b')[::-1] for b in xrange(256))
+        self.assertEqual(bits_to_str(bits), ''.join(map(chr, xrange(256))))
+        self.assertEqual(bits_to_str(unicode(bits)),
+                         ''.join(map(chr, xrange(256))))
+
+    def test_raises_if_not_binary(self):
+        self.assertRaises(ValueError, bits_to_str, '0100000011111 01')
+        self.assertRaises(ValueError, bits_to_str, '-1')
+
     def test_char_size(self):
         self.assertEqual(
             bits_to_str("000100100001011",
@@ -124,6 +150,12 @@ class StrToBitsTests(TestCase):
             str_to_bits("azAZ09"),
             '100001100101111010000010010110100000110010011100')
 
+    def test_all_bytes(self):
+        chars = ''.join(map(chr, xrange(256)))
+        bits = ''.join(format(b, '08b')[::-1] for b in xrange(256))
+        self.assertEqual(str_to_bits(chars), bits)
+        self.assertEqual(str_to_bits(unicode('az')), str_to_bits('az'))
+
     def test_char_size(self):
         self.assertEqual(
             str_to_bits('\x08\x02\x1a',